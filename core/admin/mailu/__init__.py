@@ -9,6 +9,7 @@ from gunicorn import glogging
 import logging
 
 import hmac
+import srslib
 
 class NoPingFilter(logging.Filter):
     skipAccessLogs = False
@@ -46,6 +47,10 @@ def create_app_from_config(config):
     config.init_app(app)
     models.db.init_app(app)
     utils.session.init_app(app)
+    utils.auth_cache.init_app(app)
+    utils.credential_pool.init_app(app)
+    utils.dane_cache.init_app(app)
+    utils.backend_resolver.init_app(app)
     utils.limiter.init_app(app)
     utils.babel.init_app(app, locale_selector=utils.get_locale)
     utils.login.init_app(app)
@@ -56,7 +61,11 @@ def create_app_from_config(config):
     app.device_cookie_key = hmac.new(bytearray(app.secret_key, 'utf-8'), bytearray('DEVICE_COOKIE_KEY', 'utf-8'), 'sha256').digest()
     app.temp_token_key = hmac.new(bytearray(app.secret_key, 'utf-8'), bytearray('WEBMAIL_TEMP_TOKEN_KEY', 'utf-8'), 'sha256').digest()
     app.srs_key = hmac.new(bytearray(app.secret_key, 'utf-8'), bytearray('SRS_KEY', 'utf-8'), 'sha256').digest()
+    app.srs = srslib.SRS(app.srs_key)
     app.truncated_pw_key = hmac.new(bytearray(app.secret_key, 'utf-8'), bytearray('TRUNCATED_PW_KEY', 'utf-8'), 'sha256').digest()
+    app.credential_cache_key = hmac.new(bytearray(app.secret_key, 'utf-8'), bytearray('CREDENTIAL_CACHE_KEY', 'utf-8'), 'sha256').digest()
+    app.token_digest_key = hmac.new(bytearray(app.secret_key, 'utf-8'), bytearray('TOKEN_DIGEST_KEY', 'utf-8'), 'sha256').digest()
+    app.token_digest_key_id = hmac.new(app.token_digest_key, bytearray('TOKEN_DIGEST_KEY_ID', 'utf-8'), 'sha256').hexdigest()[:8]
 
     # Initialize list of translations
     with app.app_context():
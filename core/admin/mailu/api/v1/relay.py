@@ -48,6 +48,12 @@ class Relays(Resource):
 
         if common.fqdn_in_use(data['name']):
             return { 'code': 409, 'message': f'Duplicate domain {data["name"]}'}, 409
+        if 'smtp' in data:
+            try:
+                models.Relay.parse_transport(data['name'], data['smtp'])
+            except ValueError as exc:
+                return { 'code': 400, 'message': f'Remote host {data["smtp"]} is not a valid target: {exc}'}, 400
+
         relay_model = models.Relay(name=data['name'])
         if 'smtp' in data:
             relay_model.smtp = data['smtp']
@@ -95,6 +101,12 @@ class Relay(Resource):
         if relay_found is None:
             return { 'code': 404, 'message': f'Relayed domain {name} cannot be found'}, 404
 
+        if 'smtp' in data:
+            try:
+                models.Relay.parse_transport(name, data['smtp'])
+            except ValueError as exc:
+                return { 'code': 400, 'message': f'Remote host {data["smtp"]} is not a valid target: {exc}'}, 400
+
         if 'smtp' in data:
             relay_found.smtp = data['smtp']
         if 'comment' in data:
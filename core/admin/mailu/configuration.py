@@ -42,10 +42,14 @@ DEFAULT_CONFIG = {
     'TLS_FLAVOR': 'cert',
     'INBOUND_TLS_ENFORCE': False,
     'DEFER_ON_TLS_ERROR': True,
+    'DANE_CACHE_NEGATIVE_TTL': 600,
+    'DANE_CACHE_SIZE': 10000,
     'AUTH_RATELIMIT_IP': '5/hour',
     'AUTH_RATELIMIT_IP_V4_MASK': 24,
     'AUTH_RATELIMIT_IP_V6_MASK': 48,
     'AUTH_RATELIMIT_USER': '50/day',
+    'AUTH_RATELIMIT_IP_STRATEGY': 'moving-window',
+    'AUTH_RATELIMIT_USER_STRATEGY': 'moving-window',
     'AUTH_RATELIMIT_EXEMPTION': '',
     'AUTH_RATELIMIT_EXEMPTION_LENGTH': 86400,
     'DISABLE_STATISTICS': False,
@@ -60,6 +64,7 @@ DEFAULT_CONFIG = {
     'DEFAULT_QUOTA': 1000000000,
     'MESSAGE_RATELIMIT': '200/day',
     'MESSAGE_RATELIMIT_EXEMPTION': '',
+    'MESSAGE_RATELIMIT_STRATEGY': 'moving-window',
     'RECIPIENT_DELIMITER': '',
     # Web settings
     'SITENAME': 'Mailu',
@@ -85,6 +90,9 @@ DEFAULT_CONFIG = {
     'PERMANENT_SESSION_LIFETIME': 30*24*3600,
     'SESSION_COOKIE_SECURE': None,
     'CREDENTIAL_ROUNDS': 13,
+    'CREDENTIAL_CACHE_TTL': 86400,
+    'CREDENTIAL_THREADS': None,
+    'CREDENTIAL_QUEUE': None,
     'TLS_PERMISSIVE': True,
     'TZ': 'Etc/UTC',
     'DEFAULT_SPAM_THRESHOLD': 80,
@@ -148,6 +156,7 @@ class ConfigManager:
             self.config['RATELIMIT_STORAGE_URL'] = f'redis://{self.config["REDIS_ADDRESS"]}/2'
 
         self.config['SESSION_STORAGE_URL'] = f'redis://{self.config["REDIS_ADDRESS"]}/3'
+        self.config['AUTH_CACHE_STORAGE_URL'] = f'redis://{self.config["REDIS_ADDRESS"]}/4'
         self.config['SESSION_COOKIE_SAMESITE'] = 'Strict'
         self.config['SESSION_COOKIE_HTTPONLY'] = True
         if self.config['SESSION_COOKIE_SECURE'] is None:
@@ -156,10 +165,22 @@ class ConfigManager:
         self.config['SESSION_TIMEOUT'] = int(self.config['SESSION_TIMEOUT'])
         self.config['SESSION_KEY_BITS'] = int(self.config['SESSION_KEY_BITS'])
         self.config['PERMANENT_SESSION_LIFETIME'] = int(self.config['PERMANENT_SESSION_LIFETIME'])
+        self.config['CREDENTIAL_CACHE_TTL'] = int(self.config['CREDENTIAL_CACHE_TTL'])
+        self.config['DANE_CACHE_NEGATIVE_TTL'] = int(self.config['DANE_CACHE_NEGATIVE_TTL'])
+        self.config['DANE_CACHE_SIZE'] = int(self.config['DANE_CACHE_SIZE'])
+        # by default keep a request thread free from password hashing
+        request_threads = int(os.environ.get('CPU_COUNT', '1'))
+        if self.config['CREDENTIAL_THREADS'] is None:
+            self.config['CREDENTIAL_THREADS'] = max(1, request_threads // 2)
+        self.config['CREDENTIAL_THREADS'] = int(self.config['CREDENTIAL_THREADS'])
+        if self.config['CREDENTIAL_QUEUE'] is None:
+            self.config['CREDENTIAL_QUEUE'] = max(0, request_threads - self.config['CREDENTIAL_THREADS'] - 1)
+        self.config['CREDENTIAL_QUEUE'] = int(self.config['CREDENTIAL_QUEUE'])
         self.config['AUTH_RATELIMIT_IP_V4_MASK'] = int(self.config['AUTH_RATELIMIT_IP_V4_MASK'])
         self.config['AUTH_RATELIMIT_IP_V6_MASK'] = int(self.config['AUTH_RATELIMIT_IP_V6_MASK'])
         self.config['AUTH_RATELIMIT_EXEMPTION'] = set(ipaddress.ip_network(cidr, False) for cidr in (cidr.strip() for cidr in self.config['AUTH_RATELIMIT_EXEMPTION'].split(',')) if cidr)
         self.config['MESSAGE_RATELIMIT_EXEMPTION'] = set([s for s in self.config['MESSAGE_RATELIMIT_EXEMPTION'].lower().replace(' ', '').split(',') if s])
+        self.config['WILDCARD_SENDERS'] = set([s for s in self.config['WILDCARD_SENDERS'].lower().replace(' ', '').split(',') if s])
         hostnames = [host.strip() for host in self.config['HOSTNAMES'].split(',')]
         self.config['HOSTNAMES'] = ','.join(hostnames)
         self.config['HOSTNAME'] = hostnames[0]
@@ -1,7 +1,33 @@
+from mailu import models
+from flask import current_app as app
+
 import flask
+import werkzeug.exceptions
 
 
 internal = flask.Blueprint('internal', __name__, template_folder='templates')
 
 
+def lookup_batch(lookup):
+    """ Answer a batch of lookups posted as a JSON list of [map, key] pairs.
+
+    ``lookup`` is called for every pair and returns the response of the
+    matching endpoint. The result is a JSON list of [status, value] pairs
+    in the same order.
+    """
+    results = []
+    for name, key in flask.request.get_json():
+        try:
+            response = lookup(name, key)
+        except werkzeug.exceptions.HTTPException as exc:
+            results.append([exc.code, None])
+        except Exception:
+            app.logger.exception(f'Error in batched lookup {name}/{key}')
+            models.db.session.rollback()
+            results.append([500, None])
+        else:
+            results.append([response.status_code, response.get_json()])
+    return flask.jsonify(results)
+
+
 from mailu.internal.views import *
@@ -1,9 +1,7 @@
 from mailu import models, utils
 from flask import current_app as app
-from socrate import system
 
 import urllib
-import ipaddress
 import sqlalchemy.exc
 
 SUPPORTED_AUTH_METHODS = ["none", "plain"]
@@ -34,6 +32,14 @@ STATUSES = {
         "pop3": "-ERR [LOGIN-DELAY] Retry later",
         "sieve": "AuthFailed"
     }),
+    "unavailable": ("Temporary server failure (backend unavailable)", {
+        "imap": "UNAVAILABLE",
+        "smtp": "451 4.3.0",
+        "submission": "451 4.3.0",
+        "lmtp": "451 4.3.0",
+        "pop3": "-ERR [SYS/TEMP] Retry later",
+        "sieve": "TryLater"
+    }),
 }
 
 WEBMAIL_PORTS = ['14190', '10143', '10025']
@@ -48,7 +54,7 @@ def check_credentials(user, password, ip, protocol=None, auth_port=None, source_
             app.logger.debug(f'Login attempt for: {user}/{protocol}/{auth_port} from: {ip}/{source_port}: success: webmail-token')
             return True
     if utils.is_app_token(password):
-        for token in user.tokens:
+        for token in user.find_tokens(password):
             if token.check_password(password):
                 if not token.ip or utils.is_ip_in_subnet(ip, token.ip):
                     app.logger.info(f'Login attempt for: {user}/{protocol}/{auth_port} from: {ip}/{source_port}: success: token-{token.id}: {token.comment or ""!r}')
@@ -108,8 +114,8 @@ def handle_authentication(headers):
             app.logger.warn(f'Received undecodable user/password from front: {headers.get("Auth-User", "")!r}')
         else:
             try:
-                user = models.User.query.get(user_email) if '@' in user_email else None
-            except sqlalchemy.exc.StatementError as exc:
+                user = models.AuthState.get(user_email) if '@' in user_email else None
+            except (sqlalchemy.exc.StatementError, ValueError) as exc:
                 exc = str(exc).split('\n', 1)[0]
                 app.logger.warn(f'Invalid user {user_email!r}: {exc}')
             else:
@@ -158,10 +164,4 @@ def get_server(protocol, authenticated=False):
         hostname, port = app.config['IMAP_ADDRESS'], 2525
     elif protocol == 'sieve':
         hostname, port = app.config['IMAP_ADDRESS'], 4190
-    try:
-        # test if hostname is already resolved to an ip address
-        ipaddress.ip_address(hostname)
-    except:
-        # hostname is not an ip address - so we need to resolve it
-        hostname = system.resolve_hostname(hostname)
-    return hostname, port
+    return utils.backend_resolver.get(hostname), port
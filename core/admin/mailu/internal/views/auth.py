@@ -29,7 +29,22 @@ def nginx_authentication():
         response.headers['Auth-Status'] = status
         response.headers['Auth-Error-Code'] = code
         return response
-    headers = nginx.handle_authentication(flask.request.headers)
+    try:
+        headers = nginx.handle_authentication(flask.request.headers)
+    except utils.CredentialPoolFull:
+        app.logger.warn(f'Authentication attempt from {client_ip} failed: too many password verifications pending')
+        status, code = nginx.get_status(flask.request.headers['Auth-Protocol'], 'ratelimit')
+        response = flask.Response()
+        response.headers['Auth-Status'] = status
+        response.headers['Auth-Error-Code'] = code
+        return response
+    except utils.BackendUnavailable as exc:
+        app.logger.warn(f'Authentication attempt from {client_ip} failed: unable to resolve the backend {exc}')
+        status, code = nginx.get_status(flask.request.headers['Auth-Protocol'], 'unavailable')
+        response = flask.Response()
+        response.headers['Auth-Status'] = status
+        response.headers['Auth-Error-Code'] = code
+        return response
     response = flask.Response()
     for key, value in headers.items():
         response.headers[key] = str(value)
@@ -100,12 +115,20 @@ def basic_authentication():
             response.headers['Retry-After'] = '60'
             return response
         try:
-            user = models.User.query.get(user_email) if '@' in user_email else None
-        except sqlalchemy.exc.StatementError as exc:
+            user = models.AuthState.get(user_email) if '@' in user_email else None
+        except (sqlalchemy.exc.StatementError, ValueError) as exc:
             exc = str(exc).split('\n', 1)[0]
             app.logger.warn(f'Invalid user {user_email!r}: {exc}')
         else:
-            if user is not None and nginx.check_credentials(user, password.decode('utf-8'), client_ip, "web", flask.request.headers.get('X-Real-Port', None), user_email):
+            try:
+                is_valid = user is not None and nginx.check_credentials(user, password.decode('utf-8'), client_ip, "web", flask.request.headers.get('X-Real-Port', None), user_email)
+            except utils.CredentialPoolFull:
+                app.logger.warn(f'Authentication attempt from {client_ip} failed: too many password verifications pending')
+                response = flask.Response(status=401)
+                response.headers["WWW-Authenticate"] = 'Basic realm="Authentication rate limit exceeded"'
+                response.headers['Retry-After'] = '60'
+                return response
+            if is_valid:
                 response = flask.Response()
                 response.headers["X-User"] = models.IdnaEmail.process_bind_param(flask_login, user.email, "")
                 utils.limiter.exempt_ip_from_ratelimits(client_ip)
@@ -1,15 +1,41 @@
 from mailu import models
-from mailu.internal import internal
+from mailu.internal import internal, lookup_batch
 from flask import current_app as app
 
 import flask
+import json
 import socket
 import os
+import sqlalchemy
 import sqlalchemy.exc
 
+@internal.route("/dovecot/batch", methods=["POST"])
+def dovecot_batch():
+    """ Answer many dict lookups at once, keys are resolved as for the
+    /internal/dovecot/<key> endpoints
+    """
+    prefix = flask.request.path.rsplit('/', 1)[0]
+    adapter = app.url_map.bind_to_environ(flask.request.environ)
+    def lookup(name, key):
+        endpoint, args = adapter.match(f'{prefix}/{key}', method='GET')
+        if not endpoint.startswith('internal.dovecot_'):
+            flask.abort(404)
+        return app.view_functions[endpoint](**args)
+    return lookup_batch(lookup)
+
+@internal.route("/dovecot/version")
+def dovecot_version():
+    """ Versions of the records cached by podop, see models.RoutingVersion
+    """
+    return flask.jsonify(models.RoutingVersion.get())
+
 @internal.route("/dovecot/passdb/<path:user_email>")
 def dovecot_passdb_dict(user_email):
-    user = models.User.query.get(user_email) or flask.abort(404)
+    # userdb fields are returned as well, for the prefetch userdb
+    try:
+        quota = models.User.query.filter(models.User.email==user_email).with_entities(models.User.quota_bytes).one_or_none() or flask.abort(404)
+    except sqlalchemy.exc.StatementError as exc:
+        flask.abort(404)
     allow_nets = []
     allow_nets.append(app.config["SUBNET"])
     if app.config["SUBNET6"]:
@@ -17,14 +43,36 @@ def dovecot_passdb_dict(user_email):
     return flask.jsonify({
         "password": None,
         "nopassword": "Y",
-        "allow_real_nets": ",".join(allow_nets)
+        "allow_real_nets": ",".join(allow_nets),
+        **{f"userdb_{key}": value for key, value in userdb(quota[0]).items()}
     })
 
 @internal.route("/dovecot/userdb/")
 def dovecot_userdb_dict_list():
-    return flask.jsonify([
-        user[0] for user in models.User.query.filter(models.User.enabled.is_(True)).with_entities(models.User.email).all()
-    ])
+    if 'values' not in flask.request.args:
+        return flask.jsonify([
+            user[0] for user in models.User.query.filter(models.User.enabled.is_(True)).with_entities(models.User.email).all()
+        ])
+    # stream [email, userdb] pairs, one per line, reading users by pages
+    limit = flask.request.args.get('limit', 0, type=int)
+    def rows():
+        count, last = 0, None
+        while not limit or count < limit:
+            page = USERDB_PAGE if not limit else min(USERDB_PAGE, limit - count)
+            query = models.User.query.filter(models.User.enabled.is_(True))
+            if last is not None:
+                query = query.filter(models.User.email > last)
+            users = query.order_by(models.User.email).with_entities(
+                models.User.email, models.User.quota_bytes).limit(page).all()
+            for email, quota_bytes in users:
+                yield json.dumps([email, userdb(quota_bytes)]) + "\n"
+            if len(users) < page:
+                break
+            count, last = count + len(users), users[-1][0]
+    return flask.Response(flask.stream_with_context(rows()), mimetype="application/x-ndjson")
+
+# number of users read at once when streaming the userdb
+USERDB_PAGE = 1000
 
 @internal.route("/dovecot/userdb/<path:user_email>")
 def dovecot_userdb_dict(user_email):
@@ -32,9 +80,12 @@ def dovecot_userdb_dict(user_email):
         quota = models.User.query.filter(models.User.email==user_email).with_entities(models.User.quota_bytes).one_or_none() or flask.abort(404)
     except sqlalchemy.exc.StatementError as exc:
         flask.abort(404)
-    return flask.jsonify({
-        "quota_rule": f"*:bytes={quota[0]}"
-    })
+    return flask.jsonify(userdb(quota[0]))
+
+def userdb(quota_bytes):
+    return {
+        "quota_rule": f"*:bytes={quota_bytes}"
+    }
 
 
 @internal.route("/dovecot/quota/<ns>/<path:user_email>", methods=["POST"])
@@ -47,6 +98,35 @@ def dovecot_quota(ns, user_email):
     return flask.jsonify(None)
 
 
+@internal.route("/dovecot/quota", methods=["POST"])
+def dovecot_quota_bulk():
+    """ Store many quota values at once, keys are quota/<ns>/<user_email> as
+    for /internal/dovecot/quota/<ns>/<user_email>
+    """
+    used = {}
+    for key, value in flask.request.get_json():
+        prefix, _, key = key.partition('/')
+        ns, _, user_email = key.partition('/')
+        if prefix == "quota" and ns == "storage" and '@' in user_email:
+            used[user_email] = value
+    if used:
+        # a single UPDATE for every user, leaving the columns that are
+        # otherwise updated by default untouched
+        user = models.User.__table__
+        models.db.session.execute(
+            user.update().where(user.c.email.in_(used)).values(
+                quota_bytes_used=sqlalchemy.case(
+                    *((user.c.email == email, value) for email, value in used.items()),
+                    else_=user.c.quota_bytes_used
+                ),
+                updated_at=user.c.updated_at,
+                email=user.c.email
+            )
+        )
+        models.db.session.commit()
+    return flask.jsonify(None)
+
+
 @internal.route("/dovecot/sieve/name/<script>/<path:user_email>")
 def dovecot_sieve_name(script, user_email):
     return flask.jsonify(script)
@@ -1,5 +1,5 @@
 from mailu import models, utils
-from mailu.internal import internal
+from mailu.internal import internal, lookup_batch
 from flask import current_app as app
 
 import flask
@@ -41,67 +41,13 @@ def postfix_alias_map(alias):
 def postfix_transport(email):
     if email == '*' or re.match(r'(^|.*@)\[.*\]$', email):
         return flask.abort(404)
-    _, domain_name = models.Email.resolve_domain(email)
-    relay = models.Relay.query.get(domain_name) or flask.abort(404)
-    target = relay.smtp.lower()
-    port = None
-    use_lmtp = False
-    use_mx = False
-    # strip prefixes mx: and lmtp:
-    if target.startswith('mx:'):
-        target = target[3:]
-        use_mx = True
-    elif target.startswith('lmtp:'):
-        target = target[5:]
-        use_lmtp = True
-    # split host:port or [host]:port
-    if target.startswith('['):
-        if use_mx or ']' not in target:
-            # invalid target (mx: and [] or missing ])
-            flask.abort(400)
-        host, rest = target[1:].split(']', 1)
-        if rest.startswith(':'):
-            port = rest[1:]
-        elif rest:
-            # invalid target (rest should be :port)
-            flask.abort(400)
-    else:
-        if ':' in target:
-            host, port = target.rsplit(':', 1)
-        else:
-            host = target
-    # default for empty host part is mx:domain
-    if not host:
-        if not use_lmtp:
-            host = relay.name.lower()
-            use_mx = True
-        else:
-            # lmtp: needs a host part
-            flask.abort(400)
-    # detect ipv6 address or encode host
-    if ':' in host:
-        host = f'ipv6:{host}'
-    else:
-        try:
-            host = idna.encode(host).decode('ascii')
-        except idna.IDNAError:
-            # invalid host (fqdn not encodable)
-            flask.abort(400)
-    # validate port
-    if port is not None:
-        try:
-            port = int(port, 10)
-        except ValueError:
-            # invalid port (should be numeric)
-            flask.abort(400)
-    # create transport
-    transport = 'lmtp' if use_lmtp else 'smtp'
-    # use [] when not using MX lookups or host is an ipv6 address
-    if host.startswith('ipv6:') or (not use_lmtp and not use_mx):
-        host = f'[{host}]'
-    # create port suffix
-    port = '' if port is None else f':{port}'
-    return flask.jsonify(f'{transport}:{host}{port}')
+    domain_name = email.rsplit('@', 1)[-1]
+    try:
+        return flask.jsonify(models.RelayTransport.get(domain_name))
+    except KeyError:
+        return flask.abort(404)
+    except ValueError:
+        return flask.abort(400)
 
 
 @internal.route("/postfix/recipient/map/<path:recipient>")
@@ -110,10 +56,9 @@ def postfix_recipient_map(recipient):
 
     This is meant for bounces to go back to the original sender.
     """
-    srs = srslib.SRS(flask.current_app.srs_key)
     if srslib.SRS.is_srs_address(recipient):
         try:
-            return flask.jsonify(srs.reverse(recipient))
+            return flask.jsonify(flask.current_app.srs.reverse(recipient))
         except srslib.Error as error:
             return flask.abort(404)
     return flask.abort(404)
@@ -127,31 +72,35 @@ def postfix_sender_map(sender):
     """
     if sender.count('@') > 1 or sender.startswith('"'):
         return flask.abort(404)
-    srs = srslib.SRS(flask.current_app.srs_key)
-    domain = flask.current_app.config["DOMAIN"]
     try:
-        localpart, domain_name = models.Email.resolve_domain(sender)
-    except Exception as error:
-        return flask.abort(404)
-    if models.Domain.query.get(domain_name):
+        if models.LocalDomain.contains(sender.rsplit('@', 1)[-1]):
+            return flask.abort(404)
+    except ValueError:
         return flask.abort(404)
-    return flask.jsonify(srs.forward(sender, domain))
+    domain = flask.current_app.config["DOMAIN"]
+    return flask.jsonify(flask.current_app.srs.forward(sender, domain))
 
 
 @internal.route("/postfix/sender/login/<path:sender>")
 def postfix_sender_login(sender):
-    wildcard_senders = [s for s in flask.current_app.config.get('WILDCARD_SENDERS', '').lower().replace(' ', '').split(',') if s]
-    localpart, domain_name = models.Email.resolve_domain(sender)
-    if localpart is None:
-        return flask.jsonify(",".join(wildcard_senders)) if wildcard_senders else flask.abort(404)
-    localpart = localpart[:next((i for i, ch in enumerate(localpart) if ch in flask.current_app.config.get('RECIPIENT_DELIMITER')), None)]
-    destinations = set(models.Email.resolve_destination(localpart, domain_name, True) or [])
-    destinations.update(wildcard_senders)
-    destinations.update(i[0] for i in models.User.query.filter_by(allow_spoofing=True).with_entities(models.User.email).all())
+    """ Logins owning a sender address, logins allowed to send as anybody
+    are accepted by postfix_sender_spoofing instead
+    """
+    destinations = models.SenderLogin.owners(sender)
     if destinations:
         return flask.jsonify(",".join(idna_encode(destinations)))
     return flask.abort(404)
 
+@internal.route("/postfix/sender/spoofing/<path:login>")
+def postfix_sender_spoofing(login):
+    """ Accept any sender from users allowed to spoof and wildcard senders
+    """
+    try:
+        login = models.IdnaEmail.process_bind_param(None, login, None)
+    except ValueError:
+        return flask.abort(404)
+    return flask.jsonify("OK") if login in models.SenderLogin.spoofing() else flask.abort(404)
+
 @internal.route("/postfix/sender/rate/<path:sender>")
 def postfix_sender_rate(sender):
     """ Rate limit outbound emails per sender login
@@ -161,6 +110,55 @@ def postfix_sender_rate(sender):
     user = models.User.get(sender) or flask.abort(404)
     return flask.abort(404) if user.sender_limiter.hit() else flask.jsonify("450 4.2.1 You are sending too many emails too fast.")
 
+@internal.route("/postfix/batch", methods=["POST"])
+def postfix_batch():
+    """ Answer many lookups at once, see POSTFIX_MAPS for map names
+    """
+    def lookup(name, key):
+        view = POSTFIX_MAPS.get(name) or flask.abort(404)
+        return view(key)
+    return lookup_batch(lookup)
+
+# podop map names and their lookup endpoint
+POSTFIX_MAPS = {
+    'transport': postfix_transport,
+    'alias': postfix_alias_map,
+    'dane': postfix_dane_map,
+    'domain': postfix_mailbox_domain,
+    'mailbox': postfix_mailbox_map,
+    'recipientmap': postfix_recipient_map,
+    'sendermap': postfix_sender_map,
+    'senderlogin': postfix_sender_login,
+    'senderspoofing': postfix_sender_spoofing,
+    'senderrate': postfix_sender_rate,
+}
+
+@internal.route("/postfix/snapshot")
+def postfix_snapshot_version():
+    return flask.jsonify(models.RoutingVersion.get())
+
+@internal.route("/postfix/snapshot/<section>")
+def postfix_snapshot(section):
+    rows = SNAPSHOT_SECTIONS.get(section) or flask.abort(404)
+    # read the version first, the rows are then at least as recent
+    version = models.RoutingVersion.version(section)
+    return flask.jsonify({"version": version, "data": rows()})
+
+SNAPSHOT_SECTIONS = {
+    'domain': lambda: [name for name, in models.Domain.query.with_entities(
+        models.Domain.name)],
+    'alternative': lambda: [list(row) for row in models.Alternative.query.with_entities(
+        models.Alternative.name, models.Alternative.domain_name)],
+    'user': lambda: [list(row) for row in models.User.query.with_entities(
+        models.User.email, models.User.forward_enabled,
+        models.User.forward_destination, models.User.forward_keep)],
+    'alias': lambda: [list(row) for row in models.Alias.query.with_entities(
+        models.Alias.domain_name, models.Alias.localpart,
+        models.Alias.wildcard, models.Alias.destination)],
+    'relay': lambda: [list(row) for row in models.Relay.query.with_entities(
+        models.Relay.name, models.Relay.smtp)],
+}
+
 # idna encode domain part of each address in list of addresses
 def idna_encode(addresses):
     return [
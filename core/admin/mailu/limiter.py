@@ -1,6 +1,7 @@
 from mailu import utils
 from flask import current_app as app
 import base64
+import flask
 import limits
 import limits.storage
 import limits.strategies
@@ -31,18 +32,64 @@ class LimitWraperFactory(object):
     """ Global limiter, to be used as a factory
     """
 
+    # limit types and the setting of their strategy
+    STRATEGIES = {
+        'auth-ip': 'AUTH_RATELIMIT_IP_STRATEGY',
+        'auth-user': 'AUTH_RATELIMIT_USER_STRATEGY',
+        'sender': 'MESSAGE_RATELIMIT_STRATEGY',
+    }
+
     def init_app(self, app):
         self.storage = limits.storage.storage_from_string(app.config["RATELIMIT_STORAGE_URL"])
         self.limiter = limits.strategies.MovingWindowRateLimiter(self.storage)
+        # strategy and key prefix of every limit type, the moving window
+        # keeps the historic keys
+        self.limiters = {}
+        for name, key in self.STRATEGIES.items():
+            strategy = app.config[key]
+            if strategy not in limits.strategies.STRATEGIES:
+                raise ValueError(f'{key}: unknown rate limit strategy {strategy!r}')
+            if strategy == 'moving-window':
+                self.limiters[name] = (self.limiter, name)
+            else:
+                self.limiters[name] = (limits.strategies.STRATEGIES[strategy](self.storage), f'{name}-{strategy}')
+        # configured limits are parsed once, and checked on startup
+        self.limits = {}
+        for key in ('AUTH_RATELIMIT_IP', 'AUTH_RATELIMIT_USER', 'MESSAGE_RATELIMIT'):
+            self.parse(app.config[key])
+
+    def parse(self, limit):
+        """ return the parsed limit item for a limit string """
+        if limit not in self.limits:
+            self.limits[limit] = limits.parse(limit)
+        return self.limits[limit]
 
     def get_limiter(self, limit, *args):
-        return LimitWrapper(self.limiter, limits.parse(limit), *args)
+        if args and args[0] in self.limiters:
+            limiter, prefix = self.limiters[args[0]]
+            return LimitWrapper(limiter, self.parse(limit), prefix, *args[1:])
+        return LimitWrapper(self.limiter, self.parse(limit), *args)
 
     def is_subject_to_rate_limits(self, ip):
-        return False if utils.is_exempt_from_ratelimits(ip) else not (self.storage.get(f'exempt-{ip}') > 0)
+        if utils.is_exempt_from_ratelimits(ip):
+            return False
+        # an authentication checks the exemption several times, it is read
+        # from the storage once per request
+        exempt = flask.g.setdefault('rate_limit_exempt', {}) if flask.has_app_context() else {}
+        if ip not in exempt:
+            exempt[ip] = self.storage.get(f'exempt-{ip}') > 0
+        return not exempt[ip]
 
     def exempt_ip_from_ratelimits(self, ip):
         self.storage.incr(f'exempt-{ip}', app.config["AUTH_RATELIMIT_EXEMPTION_LENGTH"], True)
+        if flask.has_app_context():
+            flask.g.setdefault('rate_limit_exempt', {})[ip] = True
+
+    def is_duplicate(self, key, limit):
+        """ mark the key as seen for the limit granularity, return whether
+            it was already seen (a single storage operation)
+        """
+        return self.storage.incr(key, self.parse(limit).GRANULARITY.seconds, True) > 1
 
     def should_rate_limit_ip(self, ip):
         limiter = self.get_limiter(app.config["AUTH_RATELIMIT_IP"], 'auth-ip')
@@ -56,9 +103,8 @@ class LimitWraperFactory(object):
         limiter = self.get_limiter(app.config['AUTH_RATELIMIT_IP'], 'auth-ip')
         client_network = utils.extract_network_from_ip(ip)
         if self.is_subject_to_rate_limits(ip):
-            if username and self.storage.get(f'dedup-{client_network}-{username}') > 0:
+            if username and self.is_duplicate(f'dedup-{client_network}-{username}', app.config['AUTH_RATELIMIT_IP']):
                 return
-            self.storage.incr(f'dedup-{client_network}-{username}', limits.parse(app.config['AUTH_RATELIMIT_IP']).GRANULARITY.seconds, True)
             limiter.hit(client_network)
 
     def should_rate_limit_user(self, username, ip, device_cookie=None, device_cookie_name=None):
@@ -72,9 +118,8 @@ class LimitWraperFactory(object):
         limiter = self.get_limiter(app.config["AUTH_RATELIMIT_USER"], 'auth-user')
         if self.is_subject_to_rate_limits(ip):
             truncated_password = hmac.new(bytearray(username, 'utf-8'), bytearray(password, 'utf-8'), 'sha256').hexdigest()[-6:]
-            if password and (self.storage.get(f'dedup2-{username}-{truncated_password}') > 0):
+            if password and self.is_duplicate(f'dedup2-{username}-{truncated_password}', app.config['AUTH_RATELIMIT_USER']):
                 return
-            self.storage.incr(f'dedup2-{username}-{truncated_password}', limits.parse(app.config['AUTH_RATELIMIT_USER']).GRANULARITY.seconds, True)
             limiter.hit(device_cookie if device_cookie_name == username else username)
             self.rate_limit_ip(ip, username)
 
@@ -2,7 +2,11 @@
 """
 
 import os
+import base64
+import hmac
 import json
+import re
+import secrets
 
 from datetime import date
 from email.mime import text
@@ -424,6 +428,66 @@ class Relay(Base):
     name = db.Column(IdnaDomain, primary_key=True, nullable=False)
     smtp = db.Column(db.String(80), nullable=True)
 
+    @staticmethod
+    def parse_transport(name, smtp):
+        """ return the postfix transport for relaying domain name to the
+            remote host smtp, invalid targets raise a ValueError
+        """
+        target = (smtp or '').lower()
+        port = None
+        use_lmtp = False
+        use_mx = False
+        # strip prefixes mx: and lmtp:
+        if target.startswith('mx:'):
+            target = target[3:]
+            use_mx = True
+        elif target.startswith('lmtp:'):
+            target = target[5:]
+            use_lmtp = True
+        # split host:port or [host]:port
+        if target.startswith('['):
+            if use_mx or ']' not in target:
+                raise ValueError('invalid target (mx: and [] or missing ])')
+            host, rest = target[1:].split(']', 1)
+            if rest.startswith(':'):
+                port = rest[1:]
+            elif rest:
+                raise ValueError('invalid target (rest should be :port)')
+        else:
+            if ':' in target:
+                host, port = target.rsplit(':', 1)
+            else:
+                host = target
+        # default for empty host part is mx:domain
+        if not host:
+            if not use_lmtp:
+                host = name.lower()
+                use_mx = True
+            else:
+                raise ValueError('lmtp: needs a host part')
+        # detect ipv6 address or encode host
+        if ':' in host:
+            host = f'ipv6:{host}'
+        else:
+            try:
+                host = idna.encode(host).decode('ascii')
+            except idna.IDNAError:
+                raise ValueError('invalid host (fqdn not encodable)')
+        # validate port
+        if port is not None:
+            try:
+                port = int(port, 10)
+            except ValueError:
+                raise ValueError('invalid port (should be numeric)')
+        # create transport
+        transport = 'lmtp' if use_lmtp else 'smtp'
+        # use [] when not using MX lookups or host is an ipv6 address
+        if host.startswith('ipv6:') or (not use_lmtp and not use_mx):
+            host = f'[{host}]'
+        # create port suffix
+        port = '' if port is None else f':{port}'
+        return f'{transport}:{host}{port}'
+
 
 class Email(object):
     """ Abstraction for an email address (localpart and domain).
@@ -519,32 +583,57 @@ class Email(object):
             else:
                 localpart_stripped = localpart[:pos]
 
+        # fetch users and aliases stored for localpart@domain_name and
+        # localpart_stripped@domain_name (emails are lowercased) at once
+        localparts = {localpart.lower()}
+        if localpart_stripped is not None:
+            localparts.add(localpart_stripped.lower())
+        emails = [f'{lp}@{domain_name}' for lp in localparts]
+        candidates = db.session.execute(sqlalchemy.union_all(
+            sqlalchemy.select(
+                sqlalchemy.literal('user').label('kind'), User.email.label('email'),
+                User.localpart, sqlalchemy.false().label('wildcard'),
+                User.forward_enabled.label('enabled'), User.forward_keep.label('keep'),
+                User.forward_destination.label('destination')
+            ).where(User.email.in_(emails)),
+            sqlalchemy.select(
+                sqlalchemy.literal('alias'), Alias.email, Alias.localpart,
+                Alias.wildcard, Alias.wildcard, Alias.wildcard, Alias.destination
+            ).where(Alias.email.in_(emails))
+        )).all()
+        users, aliases = {}, {}
+        for row in candidates:
+            found = users if row.kind == 'user' else aliases
+            found[row.email.rsplit('@', 1)[0]] = row
+
         # is localpart@domain_name or localpart_stripped@domain_name an user?
-        user = User.query.get(f'{localpart}@{domain_name}')
+        user = users.get(localpart.lower())
         if not user and localpart_stripped:
-            user = User.query.get(f'{localpart_stripped}@{domain_name}')
+            user = users.get(localpart_stripped.lower())
 
         if user:
             email = f'{localpart}@{domain_name}'
 
-            if not user.forward_enabled:
+            if not user.enabled:
                 return [email]
 
-            destination = user.forward_destination
-            if user.forward_keep or ignore_forward_keep:
+            destination = list(user.destination)
+            if user.keep or ignore_forward_keep:
                 destination.append(email)
             return destination
 
         # is localpart, domain_name or localpart_stripped@domain_name an alias?
-        if pure_alias := Alias.resolve(localpart, domain_name):
+        if pure_alias := Alias.select(localpart, domain_name,
+                aliases.get(localpart.lower())):
             if not pure_alias.wildcard:
-                return pure_alias.destination
+                return list(pure_alias.destination)
 
-        if stripped_alias := Alias.resolve(localpart_stripped, domain_name):
-            return stripped_alias.destination
+        if localpart_stripped is not None and (stripped_alias := Alias.select(
+                localpart_stripped, domain_name, aliases.get(localpart_stripped.lower()))):
+            return list(stripped_alias.destination)
 
         if pure_alias:
-            return pure_alias.destination
+            return list(pure_alias.destination)
 
         return None
 
@@ -555,7 +644,6 @@ class User(Base, Email):
 
     __tablename__ = 'user'
     _ctx = None
-    _credential_cache = {}
 
     domain = db.relationship(Domain,
         backref=db.backref('users', cascade='all, delete-orphan'))
@@ -647,22 +735,18 @@ class User(Base, Email):
         )
         return cls._ctx
 
-    def check_password(self, password):
+    def check_password(self, password, cached=True):
         """ verifies password against stored hash
             and updates hash if outdated
+            @cached: False when the credential cache was already checked
         """
         if password == '':
             return False
-        cache_result = self._credential_cache.get(self.get_id())
-        current_salt = self.password.split('$')[3] if len(self.password.split('$')) == 5 else None
-        if cache_result and current_salt:
-            cache_salt, cache_hash = cache_result
-            if cache_salt == current_salt:
-                return passlib.hash.pbkdf2_sha256.verify(password, cache_hash)
-            else:
-                # the cache is local per gunicorn; the password has changed
-                # so the local cache can be invalidated
-                del self._credential_cache[self.get_id()]
+        if cached:
+            current_salt = self.password.split('$')[3] if len(self.password.split('$')) == 5 else None
+            cache_result = utils.credential_cache.check(self.get_id(), current_salt, password)
+            if cache_result is not None:
+                return cache_result
         reference = self.password
         # strip {scheme} if that's something mailu has added
         # passlib will identify *crypt based hashes just fine
@@ -670,22 +754,20 @@ class User(Base, Email):
         if reference.startswith(('{PBKDF2}', '{BLF-CRYPT}', '{SHA512-CRYPT}', '{SHA256-CRYPT}', '{MD5-CRYPT}', '{CRYPT}')):
             reference = reference.split('}', 1)[1]
 
-        result, new_hash = User.get_password_context().verify_and_update(password, reference)
+        result, new_hash = utils.credential_pool.run(
+            User.get_password_context().verify_and_update, password, reference)
         if new_hash:
             self.password = new_hash
             db.session.add(self)
             db.session.commit()
 
         if result:
-            """The credential cache uses a low number of rounds to be fast.
-While it's not meant to be persisted to cold-storage, no additional measures
-are taken to ensure it isn't (mlock(), encrypted swap, ...) on the basis that
-we have little control over GC and string interning anyways.
-
- An attacker that can dump the process' memory is likely to find credentials
-in clear-text regardless of the presence of the cache.
+            """The credential cache stores a fast keyed digest of the password,
+the key being derived from the secret key. An attacker that can read the cache
+but not the secret key cannot verify guesses against it.
             """
-            self._credential_cache[self.get_id()] = (self.password.split('$')[3], passlib.hash.pbkdf2_sha256.using(rounds=1).hash(password))
+            parts = self.password.split('$')
+            utils.credential_cache.put(self.get_id(), parts[3] if len(parts) == 5 else None, password)
         return result
 
     def set_password(self, password, raw=False, keep_sessions=None):
@@ -695,6 +777,8 @@ in clear-text regardless of the presence of the cache.
 set() containing the sessions to keep
         """
         self.password = password if raw else User.get_password_context().hash(password)
+        if self.email is not None:
+            utils.credential_cache.delete(self.email)
         if keep_sessions is not True and self.email is not None:
             utils.MailuSessionExtension.prune_sessions(uid=self.email, keep=keep_sessions)
 
@@ -746,46 +830,97 @@ class Alias(Base, Email):
     def resolve(cls, localpart, domain_name):
         """ find aliases matching email address localpart@domain_name """
 
-        alias_preserve_case = cls.query.filter(
-                sqlalchemy.and_(cls.domain_name == domain_name,
-                    sqlalchemy.or_(
-                        sqlalchemy.and_(
-                            cls.wildcard == False,
-                            cls.localpart == localpart
-                        ), sqlalchemy.and_(
-                            cls.wildcard == True,
-                            sqlalchemy.bindparam('l', localpart).like(cls.localpart)
-                        )
-                    )
-                )
-            ).order_by(cls.wildcard, sqlalchemy.func.char_length(cls.localpart).desc()).first()
-
-        localpart_lower = localpart.lower() if localpart else None
-        alias_lower_case = cls.query.filter(
-                sqlalchemy.and_(cls.domain_name == domain_name,
-                    sqlalchemy.or_(
-                        sqlalchemy.and_(
-                            cls.wildcard == False,
-                            sqlalchemy.func.lower(cls.localpart) == localpart_lower
-                        ), sqlalchemy.and_(
-                            cls.wildcard == True,
-                            sqlalchemy.bindparam('l', localpart_lower).like(
-                                sqlalchemy.func.lower(cls.localpart))
-                        )
-                    )
-                )
-            ).order_by(cls.wildcard, sqlalchemy.func.char_length(
-                sqlalchemy.func.lower(cls.localpart)).desc()).first()
+        if localpart is None:
+            return None
 
-        if alias_preserve_case and alias_lower_case:
-            return alias_lower_case if alias_preserve_case.wildcard else alias_preserve_case
+        # the email column holds the lowercased localpart
+        alias_exact = None
+        if '@' not in localpart:
+            alias_exact = db.session.get(cls, f'{localpart.lower()}@{domain_name}')
+
+        alias = cls.select(localpart, domain_name, alias_exact)
+        if alias is None or isinstance(alias, Alias):
+            return alias
+        return db.session.get(cls, alias.email)
+
+    @classmethod
+    def select(cls, localpart, domain_name, alias_exact):
+        """ choose the alias matching localpart@domain_name, given the alias
+            stored for the lowercased address (if any), wildcard aliases are
+            returned as AliasMatcher entries
+        """
+
+        if alias_exact is not None and alias_exact.wildcard:
+            alias_exact = None
 
-        if alias_preserve_case and not alias_lower_case:
-            return alias_preserve_case
+        if alias_exact is not None and alias_exact.localpart == localpart:
+            return alias_exact
 
-        if alias_lower_case and not alias_preserve_case:
+        # an exact alias is always found by both the case sensitive and the
+        # lowercased lookup, so only a wildcard alias matches with case
+        matcher = AliasMatcher.get(domain_name)
+        alias_preserve_case = matcher.match(localpart)
+        alias_lower_case = alias_exact or matcher.match(localpart.lower(), lower=True)
+
+        if alias_preserve_case and alias_lower_case:
             return alias_lower_case
 
+        return alias_preserve_case or alias_lower_case
+
+class AliasMatcher:
+    """ Wildcard aliases of a domain with their LIKE patterns compiled to
+        regular expressions, so resolving an alias does not scan the table.
+        Matchers are rebuilt when the alias routing version changes.
+    """
+
+    # maximum number of cached domains
+    SIZE = 10000
+
+    # alias routing version and matcher by domain name
+    _cache = {}
+
+    def __init__(self, aliases):
+        self.preserve_case = self._compile(aliases, str)
+        self.lower_case = self._compile(aliases, str.lower)
+
+    @staticmethod
+    def _compile(aliases, transform):
+        """ sort like ORDER BY char_length(localpart) DESC and compile """
+        patterns = sorted(
+            ((transform(alias.localpart), alias) for alias in aliases),
+            key=lambda pattern: -len(pattern[0])
+        )
+        return [
+            (re.compile(''.join(
+                '.*' if char == '%' else '.' if char == '_' else re.escape(char)
+                for char in localpart
+            ), re.DOTALL), alias)
+            for localpart, alias in patterns
+        ]
+
+    @classmethod
+    def get(cls, domain_name):
+        """ get the matcher for a domain, rebuilt if outdated """
+        key = str(domain_name).lower()
+        version = RoutingVersion.version('alias')
+        cached = cls._cache.get(key)
+        if cached is None or cached[0] != version:
+            aliases = Alias.query.filter_by(domain_name=domain_name, wildcard=True) \
+                .with_entities(Alias.email.label('email'), Alias.localpart,
+                    Alias.wildcard, Alias.destination) \
+                .order_by(Alias.localpart).all()
+            if len(cls._cache) >= cls.SIZE:
+                cls._cache.clear()
+            cached = cls._cache[key] = (version, cls(aliases))
+        return cached[1]
+
+    def match(self, localpart, lower=False):
+        """ return the longest matching wildcard alias (email, localpart,
+            wildcard and destination)
+        """
+        for regex, alias in (self.lower_case if lower else self.preserve_case):
+            if regex.fullmatch(localpart):
+                return alias
         return None
 
 
@@ -801,11 +936,25 @@ class Token(Base):
     user = db.relationship(User,
         backref=db.backref('tokens', cascade='all, delete-orphan'))
     password = db.Column(db.String(255), nullable=False)
+    digest = db.Column(db.String(64), nullable=True, index=True)
     ip = db.Column(CommaSeparatedList, nullable=True, default=list)
 
+    @staticmethod
+    def make_digest(password):
+        """ return the keyed digest used to find a token by its password,
+            prefixed with the id of the key (see is_current_digest)
+        """
+        digest = hmac.new(app.token_digest_key, password.encode('utf-8'), 'sha256').digest()
+        return f'{app.token_digest_key_id}${base64.urlsafe_b64encode(digest).decode("ascii").rstrip("=")}'
+
+    @staticmethod
+    def is_current_digest(digest):
+        """ return whether the digest was made with the current key """
+        return digest is not None and digest.startswith(f'{app.token_digest_key_id}$')
+
     def check_password(self, password):
         """ verifies password against stored hash
-            and updates hash if outdated
+            and updates hash and digest if outdated
         """
         if self.password.startswith("$5$"):
             if passlib.hash.sha256_crypt.verify(password, self.password):
@@ -814,17 +963,194 @@ class Token(Base):
                 db.session.commit()
                 return True
             return False
-        return passlib.hash.pbkdf2_sha256.verify(password, self.password)
+        if passlib.hash.pbkdf2_sha256.verify(password, self.password):
+            digest = Token.make_digest(password)
+            if self.digest != digest:
+                # tokens created before the digest or with another secret key
+                self.digest = digest
+                db.session.add(self)
+                db.session.commit()
+            return True
+        return False
 
     def set_password(self, password):
         """ sets password using pbkdf2_sha256 (1 round) """
         # tokens have 128bits of entropy, they are not bruteforceable
         self.password = passlib.hash.pbkdf2_sha256.using(rounds=1).hash(password)
+        self.digest = Token.make_digest(password)
 
     def __repr__(self):
         return f'<Token #{self.id}: {self.comment or self.ip or self.password}>'
 
 
+class AuthState:
+    """ Login state of a user (flags, password salt and app tokens), kept in
+        the auth cache shared by the workers so that the nginx authentication
+        does not load the user. Entries are dropped when the user or its
+        tokens change.
+
+        With MEMORY_SESSIONS the cache would be local to each worker and
+        changes would only be seen by the worker committing them, so the
+        login state is then always loaded from the database.
+    """
+
+    # lifetime of cached entries in seconds, entries are dropped on change
+    TTL = 300
+
+    # user attributes stored in the cache
+    ATTRIBUTES = ('_email', 'password', 'enabled', 'enable_imap', 'enable_pop')
+
+    def __init__(self, email, enabled, enable_imap, enable_pop, salt, tokens):
+        self.email = email
+        self.enabled = enabled
+        self.enable_imap = enable_imap
+        self.enable_pop = enable_pop
+        self.salt = salt
+        self.tokens = [AuthState.Token(*token) for token in tokens]
+        self.digests = {token.digest: token for token in self.tokens if token.digest}
+
+    def __str__(self):
+        return self.email
+
+    def __repr__(self):
+        return f'<User {self.email!r}>'
+
+    def get_id(self):
+        """ return users email address """
+        return self.email
+
+    @staticmethod
+    def key(email):
+        """ return the cache key of the given email address """
+        return f'auth-{IdnaEmail.process_bind_param(None, email, None)}'.encode()
+
+    @classmethod
+    def generation_key(cls, email):
+        """ return the key of the change counter of the given email address """
+        return cls.key(email) + b'#generation'
+
+    @classmethod
+    def get(cls, email):
+        """ return the login state of the given user from the cache, loading
+            it from the database on miss (None if the user does not exist)
+        """
+        if app.config['MEMORY_SESSIONS']:
+            user = User.query.get(email)
+            return None if user is None else cls(*cls.dump(user))
+        key = cls.key(email)
+        try:
+            return cls(*json.loads(app.auth_cache.get(key)))
+        except KeyError:
+            pass
+        # the state is only stored when the user did not change while loading
+        guard = cls.generation_key(email)
+        try:
+            generation = app.auth_cache.get(guard)
+        except KeyError:
+            generation = None
+        user = User.query.get(email)
+        if user is None:
+            return None
+        state = cls.dump(user)
+        app.auth_cache.put_unchanged(key, json.dumps(state), cls.TTL, guard, generation)
+        return cls(*state)
+
+    @staticmethod
+    def dump(user):
+        """ return the arguments of the login state of the given user """
+        parts = user.password.split('$')
+        return [
+            user.email, user.enabled, user.enable_imap, user.enable_pop,
+            parts[3] if len(parts) == 5 else None,
+            [[token.id, token.password, token.ip, token.comment, token.digest] for token in user.tokens]
+        ]
+
+    @classmethod
+    def clear(cls):
+        """ drop every cached login state """
+        for key in app.auth_cache.list(b'auth-'):
+            app.auth_cache.delete(key)
+
+    def find_tokens(self, password):
+        """ return the tokens that may match an app token password, the one
+            found by digest first, then the tokens without a current digest
+        """
+        if token := self.digests.get(Token.make_digest(password)):
+            yield token
+        # tokens whose digest was not set yet, or set with another secret key
+        yield from (token for token in self.tokens if not Token.is_current_digest(token.digest))
+
+    def check_password(self, password):
+        """ verifies password against the credential cache of the user,
+            or against the stored hash on cache miss
+        """
+        if password == '':
+            return False
+        cache_result = utils.credential_cache.check(self.email, self.salt, password)
+        if cache_result is not None:
+            return cache_result
+        user = User.query.get(self.email)
+        return user is not None and user.check_password(password, cached=False)
+
+    class Token:
+        """ Cached app token of a user """
+
+        def __init__(self, id, password, ip, comment, digest=None):
+            self.id = id
+            self.password = password
+            self.ip = ip
+            self.comment = comment
+            self.digest = digest
+
+        def check_password(self, password):
+            """ verifies password against the cached hash """
+            if not self.password.startswith('$5$'):
+                if not passlib.hash.pbkdf2_sha256.verify(password, self.password):
+                    return False
+                if self.digest == Token.make_digest(password):
+                    return True
+            # outdated hashes and digests are updated by the model
+            token = db.session.get(Token, self.id)
+            return token is not None and token.check_password(password)
+
+    @classmethod
+    def _after_flush(cls, session, flush_context):
+        """ collect the users whose login state changed, once the addresses
+            of new users are set
+        """
+        emails = session.info.setdefault('auth_state', set())
+        for obj in chain(session.new, session.deleted):
+            if isinstance(obj, User):
+                emails.add(obj.email)
+            elif isinstance(obj, Token):
+                emails.add(obj.user_email or obj.user.email)
+        for obj in session.dirty:
+            if isinstance(obj, User):
+                state = inspect(obj)
+                if any(state.attrs[attr].history.has_changes() for attr in cls.ATTRIBUTES):
+                    emails.add(obj.email)
+                    # the previous address of a renamed user
+                    emails.update(state.attrs['_email'].history.deleted)
+            elif isinstance(obj, Token):
+                emails.add(obj.user_email or obj.user.email)
+
+    @classmethod
+    def _after_commit(cls, session):
+        """ drop the cached login state of changed users """
+        for email in session.info.pop('auth_state', ()):
+            if email is not None:
+                app.auth_cache.incr(cls.generation_key(email), cls.TTL)
+                app.auth_cache.delete(cls.key(email))
+
+    @classmethod
+    def _after_rollback(cls, session, previous_transaction):
+        session.info.pop('auth_state', None)
+
+sqlalchemy.event.listen(db.session, 'after_flush', AuthState._after_flush)
+sqlalchemy.event.listen(db.session, 'after_commit', AuthState._after_commit)
+sqlalchemy.event.listen(db.session, 'after_soft_rollback', AuthState._after_rollback)
+
+
 class Fetch(Base):
     """ A fetched account is a remote POP/IMAP account fetched into a local
     account.
@@ -863,6 +1189,239 @@ managers = db.Table('manager', Base.metadata,
 )
 
 
+class SenderLogin:
+    """ Logins allowed to send as a given address, and logins allowed to send
+        as anybody (users allowed to spoof and WILDCARD_SENDERS). Both are
+        cached per process until a routing version changes.
+    """
+
+    # maximum number of cached senders
+    SIZE = 10000
+
+    # routing versions the cache was built for
+    _versions = None
+
+    # logins by sender address
+    _cache = {}
+
+    # logins allowed to send as anybody
+    _spoofing = frozenset()
+
+    @classmethod
+    def _refresh(cls):
+        """ drop the cache if a routing version changed """
+        versions = RoutingVersion.get()
+        if versions != cls._versions:
+            cls._cache = {}
+            spoofing = set()
+            for email in chain(app.config['WILDCARD_SENDERS'], (
+                email for email, in User.query.filter_by(allow_spoofing=True).with_entities(User.email)
+            )):
+                try:
+                    spoofing.add(IdnaEmail.process_bind_param(None, email, None))
+                except ValueError:
+                    pass
+            cls._spoofing = frozenset(spoofing)
+            cls._versions = versions
+
+    @classmethod
+    def spoofing(cls):
+        """ return the logins allowed to send as anybody, IDNA encoded """
+        cls._refresh()
+        return cls._spoofing
+
+    @classmethod
+    def owners(cls, sender):
+        """ return the logins allowed to send as the given address """
+        cls._refresh()
+        owners = cls._cache.get(sender)
+        if owners is None:
+            localpart, domain_name = Email.resolve_domain(sender)
+            if localpart is None:
+                owners = frozenset()
+            else:
+                localpart = localpart[:next((i for i, ch in enumerate(localpart) if ch in app.config.get('RECIPIENT_DELIMITER')), None)]
+                owners = frozenset(Email.resolve_destination(localpart, domain_name, True) or [])
+            if len(cls._cache) >= cls.SIZE:
+                cls._cache.clear()
+            cls._cache[sender] = owners
+        return owners
+
+
+class RelayTransport:
+    """ Postfix transports of the relayed domains and of their alternatives,
+        parsed once and cached per process until a routing version changes.
+    """
+
+    # routing sections the table is built from
+    SECTIONS = ('alternative', 'relay')
+
+    # routing versions the table was built for
+    _versions = None
+
+    # transport by IDNA encoded domain name, None for invalid targets
+    _table = {}
+
+    @classmethod
+    def _refresh(cls):
+        """ rebuild the table if a routing version changed """
+        versions = RoutingVersion.get()
+        versions = tuple(versions.get(section) for section in cls.SECTIONS)
+        if versions != cls._versions:
+            relays = {}
+            for name, smtp in Relay.query.with_entities(Relay.name, Relay.smtp):
+                try:
+                    transport = Relay.parse_transport(name, smtp)
+                except ValueError as exc:
+                    app.logger.warning(f'Invalid relay target {smtp!r} for {name}: {exc}')
+                    transport = None
+                relays[IdnaDomain.process_bind_param(None, name, None)] = transport
+            table = dict(relays)
+            # alternatives resolve to their domain, see Email.resolve_domain
+            for name, domain_name in Alternative.query.with_entities(Alternative.name, Alternative.domain_name):
+                name = IdnaDomain.process_bind_param(None, name, None)
+                domain_name = IdnaDomain.process_bind_param(None, domain_name, None)
+                if domain_name in relays:
+                    table[name] = relays[domain_name]
+                else:
+                    table.pop(name, None)
+            cls._table = table
+            cls._versions = versions
+
+    @classmethod
+    def get(cls, domain_name):
+        """ return the transport of the given domain, raise a KeyError if it
+            is not relayed and a ValueError if its target is invalid
+        """
+        cls._refresh()
+        try:
+            domain_name = IdnaDomain.process_bind_param(None, domain_name, None)
+        except idna.IDNAError:
+            raise KeyError(domain_name)
+        transport = cls._table[domain_name]
+        if transport is None:
+            raise ValueError(f'invalid relay target for {domain_name}')
+        return transport
+
+
+class LocalDomain:
+    """ Names of the local domains and of their alternatives, cached per
+        process until a routing version changes.
+    """
+
+    # routing sections the set is built from
+    SECTIONS = ('domain', 'alternative')
+
+    # routing versions the set was built for
+    _versions = None
+
+    # IDNA encoded names
+    _names = frozenset()
+
+    @classmethod
+    def _refresh(cls):
+        """ rebuild the set if a routing version changed """
+        versions = RoutingVersion.get()
+        versions = tuple(versions.get(section) for section in cls.SECTIONS)
+        if versions != cls._versions:
+            cls._names = frozenset(
+                IdnaDomain.process_bind_param(None, name, None)
+                for name, in chain(
+                    Domain.query.with_entities(Domain.name),
+                    Alternative.query.with_entities(Alternative.name)
+                )
+            )
+            cls._versions = versions
+
+    @classmethod
+    def contains(cls, domain_name):
+        """ return whether the domain or alternative is local, names that
+            cannot be encoded raise a ValueError
+        """
+        cls._refresh()
+        return IdnaDomain.process_bind_param(None, domain_name, None) in cls._names
+
+
+class RoutingVersion:
+    """ Versions of the routing records exported to postfix as snapshot
+        sections (see internal.views.postfix), stored in the config table
+        with a row per section. A section version is bumped in the flush
+        that changes its records. The user version also covers the quota
+        cached by dovecot and the spoofing permission (see SenderLogin).
+    """
+
+    CONFIG = 'routing_version.{}'
+
+    # snapshot section and routing attributes of every model
+    SECTIONS = {
+        Domain: ('domain', ('name',)),
+        Alternative: ('alternative', ('name', 'domain_name')),
+        User: ('user', ('_email', 'localpart', 'domain_name', 'forward_enabled',
+            'forward_destination', 'forward_keep', 'quota_bytes', 'allow_spoofing')),
+        Alias: ('alias', ('_email', 'localpart', 'domain_name', 'wildcard',
+            'destination')),
+        Relay: ('relay', ('name', 'smtp')),
+    }
+
+    @classmethod
+    def get(cls):
+        """ return the current version of every section """
+        names = {cls.CONFIG.format(section): section for section, _ in cls.SECTIONS.values()}
+        return {
+            names[config.name]: config.value
+            for config in Config.query.filter(Config.name.in_(names))
+        }
+
+    @classmethod
+    def version(cls, section):
+        """ return the current version of a section, loaded once per session """
+        config = db.session.get(Config, cls.CONFIG.format(section))
+        return (config.value if config is not None else None) or ''
+
+    @classmethod
+    def bump(cls, session, sections):
+        """ set a new version for the given sections
+
+            The rows are seeded by the migrations and only updated here, so
+            concurrent writes do not race to insert them, and writes to
+            different sections do not wait for each other.
+        """
+        names = {cls.CONFIG.format(section) for section in sections}
+        version = secrets.token_hex(8)
+        result = session.execute(
+            sqlalchemy.update(Config.__table__)
+            .where(Config.__table__.c.name.in_(names))
+            .values(value=version)
+        )
+        if result.rowcount < len(names):
+            # database not created by the migrations
+            names.difference_update(session.scalars(
+                sqlalchemy.select(Config.name).where(Config.name.in_(names))
+            ))
+            session.add_all(Config(name=name, value=version) for name in names)
+
+    @classmethod
+    def _before_flush(cls, session, flush_context, instances):
+        """ bump the sections of changed routing records """
+        sections = set()
+        for obj in chain(session.new, session.deleted):
+            if type(obj) in cls.SECTIONS:
+                sections.add(cls.SECTIONS[type(obj)][0])
+            # deleting a domain cascades to every record of the domain
+            if isinstance(obj, Domain) and obj in session.deleted:
+                sections.update(section for section, _ in cls.SECTIONS.values())
+        for obj in session.dirty:
+            if type(obj) in cls.SECTIONS:
+                section, attributes = cls.SECTIONS[type(obj)]
+                state = inspect(obj)
+                if any(state.attrs[attr].history.has_changes() for attr in attributes):
+                    sections.add(section)
+        if sections:
+            cls.bump(session, sections)
+
+sqlalchemy.event.listen(db.session, 'before_flush', RoutingVersion._before_flush)
+
+
 class MailuConfig:
     """ Class which joins whole Mailu config for dumping
         and loading
@@ -1048,9 +1607,17 @@ class MailuConfig:
 
     def clear(self, models=None):
         """ remove complete configuration """
+        sections = set()
         for model in self._models:
             if models is None or model in models:
                 db.session.query(model).delete()
+                if model in RoutingVersion.SECTIONS:
+                    sections.add(RoutingVersion.SECTIONS[model][0])
+        # bulk deletes do not trigger the flush hook
+        if sections:
+            RoutingVersion.bump(db.session, sections)
+        if models is None or User in models or Token in models:
+            AuthState.clear()
 
     def check(self):
         """ check for duplicate domain names """
@@ -28,7 +28,7 @@ from pygments.lexers import get_lexer_by_name
 from pygments.lexers.data import YamlLexer
 from pygments.formatters import get_formatter_by_name
 
-from mailu import models, dkim
+from mailu import models, dkim, utils
 
 
 ma = Marshmallow()
@@ -1073,6 +1073,9 @@ class BaseSchema(ma.SQLAlchemyAutoSchema, Storage):
                 except ValueError:
                     # hash in db is invalid
                     pass
+                except utils.CredentialPoolFull:
+                    # no time to check the hash in db, keep the new one
+                    pass
                 else:
                     del inst
 
@@ -1146,6 +1149,7 @@ class TokenSchema(BaseSchema):
         load_instance = True
 
         sibling = True
+        exclude = ['digest']
 
     password = PasswordField(required=True, metadata={'model': models.User})
     hash_password = fields.Boolean(load_only=True, load_default=False)
@@ -50,7 +50,11 @@ def login():
             if utils.limiter.should_rate_limit_user(username, client_ip, device_cookie, device_cookie_username):
                 flask.flash(_('Too many attempts for this user (rate-limit)'), 'error')
                 return flask.render_template('login.html', form=form, fields=fields)
-        user = models.User.login(username, form.pw.data)
+        try:
+            user = models.User.login(username, form.pw.data)
+        except utils.CredentialPoolFull:
+            flask.flash(_('Too many login attempts, please retry later (rate-limit)'), 'error')
+            return flask.render_template('login.html', form=form, fields=fields)
         if user:
             flask.session.regenerate()
             flask_login.login_user(user)
@@ -87,7 +91,11 @@ def pw_change():
         if form.pw.data != form.pw2.data:
             flask.flash(_("The new passwords don't match"), "error")
             return flask.redirect(flask.url_for('sso.pw_change'))
-        user = models.User.login(flask_login.current_user.email, form.oldpw.data)
+        try:
+            user = models.User.login(flask_login.current_user.email, form.oldpw.data)
+        except utils.CredentialPoolFull:
+            flask.flash(_('Too many login attempts, please retry later (rate-limit)'), 'error')
+            return flask.render_template('pw_change.html', form=form)
         if user:
             flask.session.regenerate()
             flask_login.login_user(user)
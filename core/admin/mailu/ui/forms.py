@@ -2,6 +2,7 @@ from wtforms import validators, fields, widgets
 from wtforms.validators import ValidationError
 from wtforms_components import fields as fields_
 from flask_babel import lazy_gettext as _
+from mailu import models
 
 import flask_login
 import flask_wtf
@@ -58,6 +59,21 @@ class MultipleFoldersVerify(object):
         if not pattern.match(field.data.replace(" ", "")):
             raise validators.ValidationError(self.message)
 
+class RelayTargetVerify(object):
+    """ Ensure that the remote host can be used as a postfix transport """
+    def __init__(self,message=_('Invalid remote host.'),required_message=_('A relay host is required.')):
+        self.message = message
+        self.required_message = required_message
+
+    def __call__(self, form, field):
+        # the remote host defaults to the relayed domain name
+        if not (field.data or form.name.data):
+            raise validators.ValidationError(self.required_message)
+        try:
+            models.Relay.parse_transport(form.name.data or '', field.data)
+        except ValueError:
+            raise validators.ValidationError(self.message)
+
 class ConfirmationForm(flask_wtf.FlaskForm):
     submit = fields.SubmitField(_('Confirm'))
 
@@ -88,7 +104,7 @@ class AlternativeForm(flask_wtf.FlaskForm):
 
 class RelayForm(flask_wtf.FlaskForm):
     name = fields.StringField(_('Relayed domain name'), [validators.DataRequired()])
-    smtp = fields.StringField(_('Remote host'))
+    smtp = fields.StringField(_('Remote host'), [RelayTargetVerify()])
     comment = fields.StringField(_('Comment'))
     submit = fields.SubmitField(_('Save'))
 
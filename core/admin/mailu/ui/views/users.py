@@ -118,7 +118,13 @@ def _process_password_change(form, user_email):
     if form.validate_on_submit():
         if form.pw.data != form.pw2.data:
             flask.flash('Passwords do not match', 'error')
-        elif user_email or models.User.login(user_email_or_current, form.current_pw.data):
+            return flask.render_template('user/password.html', form=form, user=user)
+        try:
+            current_pw_ok = user_email or models.User.login(user_email_or_current, form.current_pw.data)
+        except utils.CredentialPoolFull:
+            flask.flash('Too many login attempts, please retry later (rate-limit)', 'error')
+            return flask.render_template('user/password.html', form=form, user=user)
+        if current_pw_ok:
             if msg := utils.isBadOrPwned(form):
                 flask.flash(msg, "error")
                 return flask.render_template('user/password.html', form=form, user=user)
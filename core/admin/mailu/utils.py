@@ -13,13 +13,18 @@ import dns.rdtypes
 import dns.rdatatype
 import dns.rdataclass
 
+import concurrent.futures
+import tenacity
 import hmac
+import json
 import secrets
 import string
+import threading
 import time
 
 from multiprocessing import Value
 from mailu import limiter
+from socrate import system
 from flask import current_app as app
 
 import flask
@@ -51,27 +56,144 @@ resolver = dns.resolver.Resolver()
 resolver.use_edns(0, dns.flags.DO, 1232)
 resolver.flags = dns.flags.AD | dns.flags.RD
 
-def has_dane_record(domain, timeout=10):
+def resolve_dane_record(domain, timeout=10):
+    """ return whether the domain has a usable TLSA record, and how long the
+        answer may be cached (None for a failed lookup)
+    """
     try:
         result = resolver.resolve(f'_25._tcp.{domain}', dns.rdatatype.TLSA,dns.rdataclass.IN, lifetime=timeout)
         if result.response.flags & dns.flags.AD:
             for record in result:
                 if isinstance(record, dns.rdtypes.ANY.TLSA.TLSA):
                     if record.usage in [2,3] and record.selector in [0,1] and record.mtype in [0,1,2]:
-                        return True
+                        return True, result.rrset.ttl
+        return False, result.rrset.ttl
     except dns.resolver.NoNameservers:
         # If the DNSSEC data is invalid and the DNS resolver is DNSSEC enabled
         # we will receive this non-specific exception. The safe behaviour is to
         # accept to defer the email.
         app.logger.warn(f'Unable to lookup the TLSA record for {domain}. Is the DNSSEC zone okay on https://dnsviz.net/d/{domain}/dnssec/?')
-        return app.config['DEFER_ON_TLS_ERROR']
+        return app.config['DEFER_ON_TLS_ERROR'], None
     except dns.exception.Timeout:
         app.logger.warn(f'Timeout while resolving the TLSA record for {domain} ({timeout}s).')
-    except (dns.resolver.NXDOMAIN, dns.name.EmptyLabel):
-        pass # this is expected, not TLSA record is fine
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer, dns.name.EmptyLabel):
+        # this is expected, not TLSA record is fine
+        return False, app.config['DANE_CACHE_NEGATIVE_TTL']
     except Exception as e:
         app.logger.info(f'Error while looking up the TLSA record for {domain} {e}')
-        pass
+    return False, None
+
+def has_dane_record(domain):
+    return dane_cache.get(domain)
+
+class DaneCache:
+    """ Per process cache of the TLSA lookups, so that a slow resolver does
+        not hold a request thread for every outbound message. Answers are
+        kept for the TTL of the record, missing records for
+        DANE_CACHE_NEGATIVE_TTL seconds and failed lookups for ERROR_TTL
+        seconds. Concurrent lookups of a domain share a single resolve, and
+        entries that were used are resolved again in the background shortly
+        before they expire.
+    """
+
+    # bounds of the record TTL, in seconds
+    MIN_TTL = 30
+    MAX_TTL = 86400
+
+    # lifetime of failed lookups, in seconds
+    ERROR_TTL = 60
+
+    # part of the TTL left when a used entry is resolved again
+    REFRESH = 0.2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # value, expiry, ttl and whether it was used, by domain
+        self.entries = {}
+        # running resolves by domain
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.resolves = 0
+        self.resolve_time = 0.0
+        self.resolve_max = 0.0
+
+    def init_app(self, app):
+        self.size = app.config['DANE_CACHE_SIZE']
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, 'dane')
+
+    def get(self, domain):
+        """ return whether the domain has a usable TLSA record """
+        domain = domain.lower()
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(domain)
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+                value, expires, ttl, used = entry
+                entry[3] = True
+                if not used or expires - now > ttl * self.REFRESH or domain in self.pending:
+                    return value
+                # serve the cached answer while it is renewed
+                self.refreshes += 1
+                future = self.pending[domain] = concurrent.futures.Future()
+                self.executor.submit(self.refresh, app._get_current_object(), domain, future)
+                return value
+            self.misses += 1
+            future = self.pending.get(domain)
+            if future is None:
+                future = self.pending[domain] = concurrent.futures.Future()
+                running = False
+            else:
+                running = True
+        # wait for the lookup started by another thread
+        if running:
+            return future.result()
+        return self.resolve(domain, future)
+
+    def refresh(self, app, domain, future):
+        with app.app_context():
+            self.resolve(domain, future)
+
+    def resolve(self, domain, future):
+        """ resolve the domain, store and return the answer """
+        start = time.monotonic()
+        try:
+            value, ttl = resolve_dane_record(domain)
+        except Exception as exc:
+            with self.lock:
+                del self.pending[domain]
+            future.set_exception(exc)
+            raise
+        now = time.monotonic()
+        elapsed = now - start
+        ttl = self.ERROR_TTL if ttl is None else min(max(ttl, self.MIN_TTL), self.MAX_TTL)
+        with self.lock:
+            self.resolves += 1
+            self.resolve_time += elapsed
+            self.resolve_max = max(self.resolve_max, elapsed)
+            if domain not in self.entries and len(self.entries) >= self.size:
+                # drop the oldest entry
+                del self.entries[next(iter(self.entries))]
+            self.entries[domain] = [value, now + ttl, ttl, False]
+            del self.pending[domain]
+        future.set_result(value)
+        app.logger.debug(f'Resolved the TLSA record for {domain} in {elapsed:.3f}s ({self.stats()})')
+        return value
+
+    def stats(self):
+        """ return the cache counters and the resolve latency """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'resolves': self.resolves,
+            'resolve_avg': self.resolve_time / self.resolves if self.resolves else 0.0,
+            'resolve_max': self.resolve_max,
+        }
+
+dane_cache = DaneCache()
 
 # Rate limiter
 limiter = limiter.LimitWraperFactory()
@@ -155,6 +277,26 @@ class RedisStore:
         """ delete item from store. """
         self.redis.delete(key)
 
+    def incr(self, key, ttl):
+        """ increment the counter stored at key. """
+        with self.redis.pipeline() as pipe:
+            pipe.incr(key)
+            pipe.expire(key, int(ttl))
+            pipe.execute()
+
+    def put_unchanged(self, key, value, ttl, guard, expected):
+        """ save item to store unless the value at guard changed from expected. """
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(guard)
+                if pipe.get(guard) != expected:
+                    return
+                pipe.multi()
+                pipe.setex(key, int(ttl), value)
+                pipe.execute()
+            except redis.WatchError:
+                pass
+
     def list(self, prefix=None):
         """ return list of keys starting with prefix """
         if prefix:
@@ -182,6 +324,15 @@ class DictStore:
         except KeyError:
             pass
 
+    def incr(self, key, ttl=None):
+        """ increment the counter stored at key. """
+        self.dict[key] = self.dict.get(key, 0) + 1
+
+    def put_unchanged(self, key, value, ttl, guard, expected):
+        """ save item to store unless the value at guard changed from expected. """
+        if self.dict.get(guard) == expected:
+            self.dict[key] = value
+
     def list(self, prefix=None):
         """ return list of keys starting with prefix """
         if prefix is None:
@@ -499,6 +650,168 @@ class MailuSessionExtension:
 cleaned = Value('i', False)
 session = MailuSessionExtension()
 
+class AuthCacheExtension:
+    """ Cache of the user login states shared by the workers, see
+        models.AuthState
+    """
+
+    def init_app(self, app):
+        if app.config.get('MEMORY_SESSIONS'):
+            app.auth_cache = DictStore()
+        else:
+            app.auth_cache = RedisStore(
+                redis.StrictRedis().from_url(app.config['AUTH_CACHE_STORAGE_URL'])
+            )
+
+auth_cache = AuthCacheExtension()
+
+class CredentialCache:
+    """ Cache of verified passwords shared by the workers, so that a known
+        password is not checked against its slow hash again. Only a keyed
+        digest of the password is stored, bound to the salt of the hash, and
+        entries expire after CREDENTIAL_CACHE_TTL seconds.
+    """
+
+    def __init__(self):
+        self.hits = Value('i', 0)
+        self.misses = Value('i', 0)
+
+    @staticmethod
+    def key(email):
+        return f'credential-{email}'.encode()
+
+    @staticmethod
+    def digest(salt, password):
+        return hmac.new(app.credential_cache_key, bytearray(f'{salt}${password}', 'utf-8'), 'sha256').hexdigest()
+
+    def check(self, email, salt, password):
+        """ return whether the password matches the cached digest, or None
+            when nothing is cached for that salt
+        """
+        try:
+            cached_salt, digest = json.loads(app.auth_cache.get(self.key(email)))
+        except KeyError:
+            cached_salt = None
+        if salt is None or cached_salt != salt:
+            with self.misses.get_lock():
+                self.misses.value += 1
+            app.logger.debug(f'Credential cache miss for {email} (hits: {self.hits.value}, misses: {self.misses.value})')
+            return None
+        with self.hits.get_lock():
+            self.hits.value += 1
+        return hmac.compare_digest(digest, self.digest(salt, password))
+
+    def put(self, email, salt, password):
+        """ cache a verified password """
+        if salt and (ttl := app.config['CREDENTIAL_CACHE_TTL']):
+            app.auth_cache.put(self.key(email), json.dumps([salt, self.digest(salt, password)]), ttl)
+
+    def delete(self, email):
+        """ drop the cached password of a user """
+        app.auth_cache.delete(self.key(email))
+
+credential_cache = CredentialCache()
+
+class CredentialPoolFull(Exception):
+    """ Raised when too many password hashes are waiting to be verified """
+
+class CredentialPool:
+    """ Bounded pool of threads verifying password hashes, so that a burst
+        of logins cannot take every request thread. When CREDENTIAL_THREADS
+        hashes are running and CREDENTIAL_QUEUE more are waiting, further
+        verifications fail right away with CredentialPoolFull.
+    """
+
+    def init_app(self, app):
+        threads = app.config['CREDENTIAL_THREADS']
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads, 'credential')
+        self.slots = threading.BoundedSemaphore(threads + app.config['CREDENTIAL_QUEUE'])
+
+    def run(self, function, *args):
+        """ run the function in the pool and return its result """
+        if not self.slots.acquire(blocking=False):
+            raise CredentialPoolFull()
+        try:
+            future = self.executor.submit(function, *args)
+        except:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future.result()
+
+credential_pool = CredentialPool()
+
+class BackendUnavailable(Exception):
+    """ Raised when the address of a backend host is not known """
+
+class BackendResolver:
+    """ Addresses of the backend hosts (IMAP_ADDRESS and SMTP_ADDRESS),
+        resolved at startup and then every REFRESH seconds on a background
+        thread, so that an authentication never waits for DNS. The last
+        known address is kept while a host cannot be resolved. Hosts that
+        were never resolved fail right away with BackendUnavailable and are
+        retried every RETRY seconds.
+    """
+
+    # seconds between two resolutions of the hosts
+    REFRESH = 30
+
+    # seconds between two resolutions while a host is unknown
+    RETRY = 5
+
+    def init_app(self, app):
+        self.logger = app.logger
+        self.lock = threading.Lock()
+        self.thread = None
+        self.addresses = {}
+        self.hostnames = set()
+        for key in ('IMAP_ADDRESS', 'SMTP_ADDRESS'):
+            if not (hostname := app.config.get(key)):
+                continue
+            try:
+                # test if hostname is already resolved to an ip address
+                ipaddress.ip_address(hostname)
+            except ValueError:
+                self.hostnames.add(hostname)
+            else:
+                self.addresses[hostname] = hostname
+        for hostname in self.hostnames:
+            self.resolve(hostname)
+
+    def resolve(self, hostname):
+        """ resolve the host once, without retrying """
+        try:
+            address = system.resolve_hostname.retry_with(
+                stop=tenacity.stop_after_attempt(1), reraise=True
+            )(hostname)
+        except Exception:
+            return
+        if self.addresses.get(hostname) != address:
+            self.logger.info(f'Backend {hostname} resolved to {address}')
+            self.addresses[hostname] = address
+
+    def run(self):
+        while True:
+            time.sleep(self.RETRY if self.hostnames - self.addresses.keys() else self.REFRESH)
+            for hostname in list(self.hostnames):
+                self.resolve(hostname)
+
+    def get(self, hostname):
+        """ return the address of the host """
+        # the thread is started in the worker, after gunicorn forked
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name='backend', daemon=True)
+                    self.thread.start()
+        try:
+            return self.addresses[hostname]
+        except KeyError:
+            self.hostnames.add(hostname)
+            raise BackendUnavailable(hostname)
+
+backend_resolver = BackendResolver()
+
 # this is used by the webmail to authenticate IMAP/SMTP
 def verify_temp_token(email, token):
     try:
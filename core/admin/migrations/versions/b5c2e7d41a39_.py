@@ -0,0 +1,42 @@
+"""Seed the routing versions
+
+Revision ID: b5c2e7d41a39
+Revises: effd218f5fbf
+Create Date: 2026-10-18 19:12:07.204518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b5c2e7d41a39'
+down_revision = 'effd218f5fbf'
+
+from alembic import op
+import sqlalchemy as sa
+import datetime
+import secrets
+
+
+config_table = sa.Table(
+    'config',
+    sa.MetaData(),
+    sa.Column('name', sa.String(length=255), nullable=False),
+    sa.Column('value', sa.String(length=255), nullable=True),
+    sa.Column('created_at', sa.Date(), nullable=False),
+)
+
+# one row per snapshot section, the version is only updated afterwards
+SECTIONS = ('domain', 'alternative', 'user', 'alias', 'relay')
+
+
+def upgrade():
+    connection = op.get_bind()
+    connection.execute(config_table.delete().where(config_table.c.name == 'routing_version'))
+    op.bulk_insert(config_table, [
+        {'name': f'routing_version.{section}', 'value': f'"{secrets.token_hex(8)}"', 'created_at': datetime.date.today()}
+        for section in SECTIONS
+    ])
+
+
+def downgrade():
+    connection = op.get_bind()
+    connection.execute(config_table.delete().where(config_table.c.name.like('routing\\_version.%', escape='\\')))
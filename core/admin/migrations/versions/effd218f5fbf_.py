@@ -0,0 +1,25 @@
+"""Add token.digest
+
+Revision ID: effd218f5fbf
+Revises: 0ba45693748d
+Create Date: 2026-10-18 18:05:41.562307
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'effd218f5fbf'
+down_revision = '0ba45693748d'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # the digest of existing tokens is set on their next successful use
+    op.add_column('token', sa.Column('digest', sa.String(length=64), nullable=True))
+    op.create_index('ix_token_digest', 'token', ['digest'])
+
+
+def downgrade():
+    op.drop_index('ix_token_digest', table_name='token')
+    op.drop_column('token', 'digest')
@@ -70,6 +70,8 @@ cmdline = [
     "--logger-class mailu.Logger",
     f"--log-level {os.environ.get('LOG_LEVEL', 'INFO')}",
     "--worker-tmp-dir /dev/shm",
+    # keep podop connections open longer than its own idle timeout
+    "--keep-alive", "75",
     "--error-logfile", "-",
     "--preload"
 ]
@@ -0,0 +1,72 @@
+import os
+import unittest
+
+os.environ.update(
+    SQLALCHEMY_DATABASE_URI="sqlite://",
+    MEMORY_SESSIONS="true",
+    RATELIMIT_STORAGE_URL="memory://",
+    REDIS_ADDRESS="127.0.0.1",
+    IMAP_ADDRESS="127.0.0.1",
+    SMTP_ADDRESS="127.0.0.1",
+    RECIPIENT_DELIMITER="+",
+)
+
+import sqlalchemy
+
+import mailu
+from mailu import models
+
+
+class TestResolveDestination(unittest.TestCase):
+    """ Test the queries issued to resolve a recipient
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = mailu.create_app()
+        cls.context = cls.app.app_context()
+        cls.context.push()
+        db = models.db
+        db.create_all()
+        db.session.add(models.Domain(name="example.com"))
+        db.session.add(models.User(email="user@example.com", password="x"))
+        db.session.add(models.Alias(email="team@example.com", destination=["user@example.com"]))
+        db.session.add(models.Alias(email="sales%@example.com", wildcard=True, destination=["team@example.com"]))
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.context.pop()
+
+    def resolve(self, localpart, domain_name="example.com"):
+        """ Resolve the recipient in a new session, return the destination
+        and the number of queries
+        """
+        models.db.session.remove()
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        sqlalchemy.event.listen(models.db.engine, "before_cursor_execute", count)
+        try:
+            destination = models.Email.resolve_destination(localpart, domain_name)
+        finally:
+            sqlalchemy.event.remove(models.db.engine, "before_cursor_execute", count)
+        return destination, len(statements)
+
+    def test_user(self):
+        self.assertEqual(self.resolve("user"), (["user@example.com"], 1))
+        self.assertEqual(self.resolve("user+tag"), (["user+tag@example.com"], 1))
+
+    def test_alias(self):
+        self.assertEqual(self.resolve("team"), (["user@example.com"], 1))
+
+    def test_wildcard(self):
+        models.AliasMatcher._cache.clear()
+        destination, rebuilt = self.resolve("sales-eu")
+        self.assertEqual(destination, ["team@example.com"])
+        self.assertLessEqual(rebuilt, 3)
+        self.assertEqual(self.resolve("sales-us"), (["team@example.com"], 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
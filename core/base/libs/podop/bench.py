@@ -0,0 +1,134 @@
+""" Micro-benchmark of the netstring decoder
+
+Feeds small and large netstrings, pipelined or split across reads, through
+the netstring decoder and through the decoder it replaced, and prints the
+time spent per netstring. Run it with ``python bench.py``.
+"""
+
+import timeit
+
+from podop import postfix
+
+
+class FakeTransport(object):
+    """ Transport that is never closing
+    """
+
+    def is_closing(self):
+        return False
+
+
+class NewDecoder(postfix.NetstringProtocol):
+    """ Current decoder, counting the netstrings it receives
+    """
+
+    def __init__(self):
+        super(NewDecoder, self).__init__()
+        self.transport = FakeTransport()
+        self.count = 0
+
+    def string_received(self, string):
+        self.count += 1
+
+
+class OldDecoder(object):
+    """ Decoder replaced by the current one, buffer growth fixed (it called
+    bytearray.append with a bytearray) so that large netstrings can be
+    measured. It only decodes the first netstring of a segment.
+    """
+
+    BASE_BUFFER = 1024
+
+    def __init__(self):
+        self.count = 0
+        self.init_buffer()
+
+    def init_buffer(self):
+        self.len = None
+        self.separator = -1
+        self.index = 0
+        self.buffer = bytearray(OldDecoder.BASE_BUFFER)
+
+    def data_received(self, data):
+        missing = len(data) - len(self.buffer) + self.index
+        if missing > 0:
+            self.buffer += bytearray(missing + 1)
+        new_index = self.index + len(data)
+        self.buffer[self.index:new_index] = data
+        self.index = new_index
+        if self.len is None:
+            self.separator = self.buffer.find(0x3a)
+            if self.separator != -1 and self.buffer[:self.separator].isdigit():
+                self.len = int(self.buffer[:self.separator], 10)
+        if self.len is not None:
+            if self.index - self.separator == self.len + 2:
+                string = self.buffer[self.separator + 1:self.index - 1]
+                self.init_buffer()
+                self.string_received(string)
+
+    def string_received(self, string):
+        self.count += 1
+
+
+def netstring(size):
+    key = b"alias " + b"x" * (size - 6)
+    return b"%d:%s," % (len(key), key)
+
+
+def segments(size, count, pipelined, read=None):
+    """ Return the segments carrying count netstrings of the given size,
+    all in one segment when pipelined, else one per segment, split in
+    reads of the given size
+    """
+    strings = [netstring(size)] * count
+    streams = [b"".join(strings)] if pipelined else strings
+    if read is None:
+        return streams
+    return [
+        stream[start:start + read]
+        for stream in streams for start in range(0, len(stream), read)
+    ]
+
+
+def measure(decoder, data, count, repeat=5):
+    """ Return the best time per netstring in microseconds and the number of
+    netstrings decoded
+    """
+    def run():
+        protocol = decoder()
+        for segment in data:
+            protocol.data_received(segment)
+        return protocol
+    decoded = run().count
+    number = max(1, 20000 // count)
+    best = min(timeit.repeat(run, number=number, repeat=repeat))
+    return best / number / count * 1e6, decoded
+
+
+CASES = (
+    # name, netstring size, count, pipelined, read size
+    ("small, one per read", 32, 1000, False, None),
+    ("small, 1000 pipelined", 32, 1000, True, None),
+    ("small, 1000 pipelined, 4 KiB reads", 32, 1000, True, 4096),
+    ("large, one per read", 32768, 10, False, None),
+    ("large, 4 KiB reads", 32768, 10, False, 4096),
+    ("large, 10 pipelined, 4 KiB reads", 32768, 10, True, 4096),
+)
+
+
+def main():
+    print("{:<36} {:>16} {:>16}".format("case", "old (us/string)", "new (us/string)"))
+    for name, size, count, pipelined, read in CASES:
+        data = segments(size, count, pipelined, read)
+        results = []
+        for decoder in (OldDecoder, NewDecoder):
+            elapsed, decoded = measure(decoder, data, count)
+            if decoded == count:
+                results.append("{:.2f}".format(elapsed))
+            else:
+                results.append("{} of {} lost".format(count - decoded, count))
+        print("{:<36} {:>16} {:>16}".format(name, *results))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,9 +5,11 @@ It is able to proxify postfix maps and dovecot dicts to any table
 
 import asyncio
 import logging
+import signal
 import sys
+import weakref
 
-from podop import postfix, dovecot, table
+from podop import postfix, dovecot, table, sql, snapshot
 
 
 SERVER_TYPES = dict(
@@ -16,31 +18,93 @@ SERVER_TYPES = dict(
 )
 
 TABLE_TYPES = dict(
-    url=table.UrlTable
+    url=table.UrlTable,
+    sql=sql.SqlTable,
+    snapshot=snapshot.SnapshotTable
 )
 
 
-def run_server(verbosity, server_type, socket, tables):
+def run_server(verbosity, server_type, socket, tables, http=None):
     """ Run the server, given its type, socket path and table list
 
-    The table list must be a list of tuples (name, type, param)
+    The table list must be a list of tuples (name, type, param) or
+    (name, type, param, options), where options is a dictionary of
+    ``table.CachedTable`` settings (``ttl``, ``negative_ttl``, ``size``)
+    enabling an in-process cache for that table. ``version`` may be set to
+    a version URL followed by ``#`` and a key (see ``table.VersionWatch``)
+    so that the cache is dropped whenever that version changes.
+
+    Identical concurrent lookups are coalesced into a single one, unless
+    ``coalesce`` is set to ``False`` in the options (for tables whose
+    lookups have side effects).
+
+    When ``batch`` is set to a URL in the options, lookups are grouped with
+    the lookups of every table sharing that URL and sent together (see
+    ``table.HttpBatch``), the table name being used as the map name.
+
+    When ``write_behind`` is set to a URL in the options, sets are kept in
+    memory and written in batches to that URL at most ``write_delay``
+    seconds later (see ``table.WriteBehindTable``). Pending values are
+    written when the server stops, once the open connections have
+    answered their running commands.
+
+    HTTP connections are pooled for the whole process, ``http`` is an
+    optional dictionary of ``table.HttpPool`` settings (connection limits
+    and timeouts).
     """
-    # Prepare the maps
-    table_map = {
-        name: TABLE_TYPES[table_type](param)
-        for name, table_type, param in tables
-    }
+    # Prepare the maps, sharing a single connection pool
+    pool = table.HttpPool(**(http or {}))
+    batches = {}
+    writers = []
+    table_map = {}
+    for name, table_type, param, *options in tables:
+        options = dict(options[0]) if options and options[0] else {}
+        table_map[name] = TABLE_TYPES[table_type](param, pool)
+        if batch_url := options.pop("batch", None):
+            if batch_url not in batches:
+                batches[batch_url] = table.HttpBatch(batch_url, pool)
+            table_map[name] = table.BatchTable(table_map[name], name, batches[batch_url])
+        if write_url := options.pop("write_behind", None):
+            table_map[name] = table.WriteBehindTable(
+                table_map[name], write_url, pool,
+                options.pop("write_delay", table.WriteBehindTable.DELAY)
+            )
+            writers.append(table_map[name])
+        if options.pop("coalesce", True):
+            table_map[name] = table.SingleFlightTable(table_map[name])
+        if options:
+            if version := options.pop("version", None):
+                options["version"] = table.VersionWatch.get(version, pool)
+            table_map[name] = table.CachedTable(table_map[name], **options)
     # Run the main loop
     logging.basicConfig(stream=sys.stderr, level=max(3 - verbosity, 0) * 10,
                         format='%(name)s (%(levelname)s): %(message)s')
     loop = asyncio.get_event_loop()
-    server = loop.run_until_complete(loop.create_unix_server(
-        SERVER_TYPES[server_type].factory(table_map), socket
-    ))
+    loop.run_until_complete(pool.open())
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    factory = SERVER_TYPES[server_type].factory(table_map)
+    connections = weakref.WeakSet()
+    def connect():
+        connection = factory()
+        connections.add(connection)
+        return connection
+    server = loop.run_until_complete(loop.create_unix_server(connect, socket))
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         pass
-    server.close()
-    loop.run_until_complete(server.wait_closed())
-    loop.close()
+    finally:
+        server.close()
+        loop.run_until_complete(asyncio.gather(*(
+            connection.close() for connection in list(connections)
+            if hasattr(connection, "transport") and not connection.transport.is_closing()
+        )))
+        loop.run_until_complete(server.wait_closed())
+        for writer in writers:
+            loop.run_until_complete(writer.close())
+        for table_type in TABLE_TYPES.values():
+            if hasattr(table_type, "close"):
+                loop.run_until_complete(table_type.close())
+        loop.run_until_complete(table.VersionWatch.close())
+        loop.run_until_complete(pool.close())
+        loop.close()
@@ -2,6 +2,7 @@
 """
 
 import asyncio
+import collections
 import logging
 import json
 
@@ -10,7 +11,11 @@ class DictProtocol(asyncio.Protocol):
     """ Protocol to answer Dovecot dict requests, as implemented in Dict proxy.
 
     Only a subset of operations is handled properly by this proxy: hello,
-    lookup and transaction-based set.
+    lookup, iterate and transaction-based set.
+
+    Commands may be pipelined: they are processed concurrently but replies
+    are written in command order. When too many commands are outstanding on
+    a connection, reading from it is paused until they are answered.
 
     There is very little documentation about the protocol, most of it was
     reverse-engineered from :
@@ -22,6 +27,12 @@ class DictProtocol(asyncio.Protocol):
 
     DATA_TYPES = {0: str, 1: int}
 
+    # Maximum length of a command line, longer lines close the connection
+    MAX_LINE = 1048576
+
+    # Maximum number of outstanding commands per connection
+    MAX_PENDING = 64
+
     def __init__(self, table_map):
         self.table_map = table_map
         # Minor and major versions are not properly checked yet, but stored
@@ -35,38 +46,110 @@ class DictProtocol(asyncio.Protocol):
         self.transactions = {}
         # Dictionary of user per transaction id
         self.transactions_user = {}
+        # Incomplete command line carried over to the next segment
+        self.buffer = bytearray()
+        # Running commands in command order, only the first one may reply
+        self.pending = collections.deque()
+        self.turns = {}
+        self.paused = False
+        # Set while the transport buffer is full
+        self.drained = None
         super(DictProtocol, self).__init__()
 
     def connection_made(self, transport):
         logging.info('Connect {}'.format(transport.get_extra_info('peername')))
         self.transport = transport
-        self.transport_lock = asyncio.Lock()
+
+    def connection_lost(self, exc):
+        for task in self.pending:
+            task.cancel()
+        self.pending.clear()
+        self.turns.clear()
+
+    async def close(self):
+        """ Stop reading, let the running commands reply, then close the
+        connection
+        """
+        # reading is not resumed when the commands are done
+        self.paused = False
+        self.transport.pause_reading()
+        if self.pending:
+            await asyncio.wait(list(self.pending))
+        self.transport.close()
 
     def data_received(self, data):
         logging.debug("Received {}".format(data))
-        results = []
-        # Every command is separated by "\n"
-        for line in data.split(b"\n"):
-            # A command must at list have a type and one argument
-            if len(line) < 2:
-                continue
-            # The command function will handle the command itself
-            command = DictProtocol.COMMANDS.get(line[0])
-            if command is None:
-                logging.warning('Unknown command {}'.format(line[0]))
-                return self.transport.abort()
-            # Args are separated by "\t"
-            args = line[1:].strip().split(b"\t")
-            try:
-                future = command(self, *args)
-                if future:
-                    results.append(future)
-            except Exception:
-                logging.exception("Error when processing request")
-                return self.transport.abort()
-        # For asyncio consistency, wait for all results to fire before
-        # actually returning control
-        return asyncio.gather(*results)
+        self.buffer += data
+        # Every command is terminated by "\n", the last line may be incomplete
+        start = 0
+        while not self.transport.is_closing():
+            end = self.buffer.find(b"\n", start)
+            if end == -1:
+                break
+            self.line_received(bytes(self.buffer[start:end]))
+            start = end + 1
+        del self.buffer[:start]
+        if len(self.buffer) > self.MAX_LINE:
+            logging.warning("Command line too long")
+            self.transport.abort()
+
+    def line_received(self, line):
+        # A command must at list have a type and one argument
+        if len(line) < 2:
+            return
+        # The command function will handle the command itself
+        command = DictProtocol.COMMANDS.get(line[0])
+        if command is None:
+            logging.warning('Unknown command {}'.format(line[0]))
+            return self.transport.abort()
+        # Args are separated by "\t" and escaped
+        args = [tabunescape(arg) for arg in line[1:].split(b"\t")]
+        try:
+            result = command(self, *args)
+        except Exception:
+            logging.exception("Error when processing request")
+            return self.transport.abort()
+        if asyncio.iscoroutine(result):
+            self.queue_command(result)
+
+    def queue_command(self, coroutine):
+        """ Run a command concurrently with the previous ones, its replies
+        are written once every previous command is finished
+        """
+        task = asyncio.ensure_future(coroutine)
+        self.turns[task] = asyncio.get_event_loop().create_future()
+        if not self.pending:
+            self.turns[task].set_result(True)
+        self.pending.append(task)
+        task.add_done_callback(self.command_done)
+        if len(self.pending) >= self.MAX_PENDING and not self.paused:
+            logging.debug("Too many pending commands, pause reading")
+            self.paused = True
+            self.transport.pause_reading()
+
+    def command_done(self, task):
+        """ Let the next finished or waiting commands reply
+        """
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Error when processing request", exc_info=task.exception())
+            self.transport.abort()
+        while self.pending and self.pending[0].done():
+            self.turns.pop(self.pending.popleft(), None)
+        if self.pending:
+            turn = self.turns[self.pending[0]]
+            if not turn.done():
+                turn.set_result(True)
+        if self.paused and len(self.pending) < self.MAX_PENDING:
+            self.paused = False
+            self.transport.resume_reading()
+
+    def pause_writing(self):
+        self.drained = asyncio.get_event_loop().create_future()
+
+    def resume_writing(self):
+        if self.drained is not None:
+            self.drained.set_result(True)
+            self.drained = None
 
     def process_hello(self, major, minor, value_type, user, dict_name):
         """ Process a dict protocol hello message
@@ -78,29 +161,26 @@ class DictProtocol(asyncio.Protocol):
         logging.debug("Client {}.{} type {}, user {}, dict {}".format(
             self.major, self.minor, self.value_type, self.user, dict_name))
 
-    async def process_lookup(self, key, user=None, is_iter=False):
+    async def process_lookup(self, key, user=None):
         """ Process a dict lookup message
         """
         logging.debug("Looking up {} for {}".format(key, user))
-        orig_key = key
         # Priv and shared keys are handled slighlty differently
         key_type, key = key.decode("utf8").split("/", 1)
         try:
             result = await self.dict.get(
                 key, ns=((user.decode("utf8") if user else self.user) if key_type == "priv" else None)
             )
-            if type(result) is str:
-                response = result.encode("utf8")
-            elif type(result) is bytes:
-                response = result
-            else:
-                response = json.dumps(result).encode("ascii")
-            return await (self.reply(b"O", orig_key, response) if is_iter else self.reply(b"O", response))
+            return await self.reply(b"O", encode_value(result))
         except KeyError:
             return await self.reply(b"N")
 
     async def process_iterate(self, flags, max_rows, path, user=None):
         """ Process an iterate command
+
+        Keys and values are fetched in a single streamed request, the row
+        limit is applied by the table, and every row is written as soon as
+        it is received.
         """
         logging.debug("Iterate flags {} max_rows {} on {} for {}".format(flags, max_rows, path, user))
         # Priv and shared keys are handled slighlty differently
@@ -109,24 +189,12 @@ class DictProtocol(asyncio.Protocol):
         flags = int(flags.decode("utf-8"))
         if flags != 0: # not implemented
             return await self.reply(b"F")
-        rows = []
         try:
-            result = await self.dict.iter(key)
-            logging.debug("Found {} entries: {}".format(len(result), result))
-            for i,k in enumerate(result):
-                if max_rows > 0 and i >= max_rows:
-                    break
-                rows.append(self.process_lookup((path.decode("utf8")+k).encode("utf8"), user, is_iter=True))
-            await asyncio.gather(*rows)
-            async with self.transport_lock:
-                self.transport.write(b"\n") # ITER_FINISHED
-            return
+            async for row_key, value in self.dict.iter_items(key, max_rows):
+                await self.reply(b"O", path + row_key.encode("utf8"), encode_value(value))
         except KeyError:
             return await self.reply(b"F")
-        except Exception as e:
-            for task in rows:
-                task.cancel()
-            raise e
+        await self.write(b"\n") # ITER_FINISHED
 
     def process_begin(self, transaction_id, user=None):
         """ Process a dict begin message
@@ -158,11 +226,20 @@ class DictProtocol(asyncio.Protocol):
         return await self.reply(b"O", transaction_id)
 
     async def reply(self, command, *args):
-        async with self.transport_lock:
-            logging.debug("Replying {} with {}".format(command, args))
-            self.transport.write(command)
-            self.transport.write(b"\t".join(map(tabescape, args)))
-            self.transport.write(b"\n")
+        logging.debug("Replying {} with {}".format(command, args))
+        await self.write(command + b"\t".join(map(tabescape, args)) + b"\n")
+
+    async def write(self, data):
+        """ Write once the previous commands replied and the transport
+        buffer has room
+        """
+        turn = self.turns.get(asyncio.current_task())
+        if turn is not None:
+            await turn
+        if self.drained is not None:
+            await asyncio.shield(self.drained)
+        if not self.transport.is_closing():
+            self.transport.write(data)
 
     @classmethod
     def factory(cls, table_map):
@@ -180,6 +257,16 @@ class DictProtocol(asyncio.Protocol):
     }
 
 
+def encode_value(value):
+    """ Encode a table value for a dict reply
+    """
+    if type(value) is str:
+        return value.encode("utf8")
+    elif type(value) is bytes:
+        return value
+    return json.dumps(value).encode("ascii")
+
+
 def tabescape(unescaped):
     """ Escape a string using the specific Dovecot tabescape
     See: https://github.com/dovecot/core/blob/master/src/lib/strescape.c
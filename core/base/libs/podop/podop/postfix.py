@@ -2,66 +2,110 @@
 """
 
 import asyncio
+import collections
 import logging
 
 class NetstringProtocol(asyncio.Protocol):
     """ Netstring asyncio protocol implementation.
 
     For protocol details, see https://cr.yp.to/proto/netstrings.txt
-    """
 
-    # Length of the smallest allocated buffer, larger buffers will be
-    # allocated dynamically
-    BASE_BUFFER = 1024
+    Every complete netstring in a segment is decoded in a single pass, so
+    pipelined requests are all handled. Only the incomplete tail of a
+    segment is kept in the buffer, and it is not decoded again until the
+    netstring it starts is complete.
+    """
 
-    # Maximum length of a buffer, will crash when exceeded
+    # Maximum length of a netstring, longer netstrings are discarded
     MAX_BUFFER = 65535
 
+    # Maximum number of digits in the length prefix
+    MAX_LENGTH_DIGITS = 9
+
     def __init__(self):
         super(NetstringProtocol, self).__init__()
-        self.init_buffer()
-
-    def init_buffer(self):
-        self.len = None  # None when waiting for a length to be sent)
-        self.separator = -1  # -1 when not yet detected (str.find)
-        self.index = 0  # relative to the buffer
-        self.buffer = bytearray(NetstringProtocol.BASE_BUFFER)
+        self.buffer = bytearray()
+        # Number of bytes left to discard from an oversized netstring
+        self.skip = 0
+        # Length the buffer must reach before the next netstring is complete
+        self.needed = 0
 
     def data_received(self, data):
-        # Manage the buffer
-        missing = len(data) - len(self.buffer) + self.index
-        if missing > 0:
-            if len(self.buffer) + missing > NetstringProtocol.MAX_BUFFER:
-                raise IOError("Not enough space when decoding netstring")
-            self.buffer.append(bytearray(missing + 1))
-        new_index = self.index + len(data)
-        self.buffer[self.index:new_index] = data
-        self.index = new_index
-        # Try to detect a length at the beginning of the string
-        if self.len is None:
-            self.separator = self.buffer.find(0x3a)
-            if self.separator != -1 and self.buffer[:self.separator].isdigit():
-                self.len = int(self.buffer[:self.separator], 10)
-        # Then get the complete string
-        if self.len is not None:
-            if self.index - self.separator == self.len + 2:
-                string = self.buffer[self.separator + 1:self.index - 1]
-                self.init_buffer()
-                self.string_received(string)
+        # Drop what remains of an oversized netstring
+        if self.skip:
+            skipped = min(self.skip, len(data))
+            self.skip -= skipped
+            data = data[skipped:]
+        # Only copy the data when a previous segment left an incomplete
+        # netstring, otherwise decode the segment as received
+        if self.buffer:
+            self.buffer += data
+            if len(self.buffer) < self.needed:
+                return
+            # Deleting the head of a bytearray does not move the tail
+            del self.buffer[:self.decode(self.buffer)]
+        else:
+            offset = self.decode(data)
+            if offset < len(data):
+                self.buffer += memoryview(data)[offset:]
+
+    def decode(self, data):
+        """ Decode every complete netstring in the data, return the offset
+        of the first byte that was not consumed
+        """
+        offset, size = 0, len(data)
+        self.needed = 0
+        while offset < size and not self.transport.is_closing():
+            # Locate the length prefix
+            separator = data.find(b":", offset, offset + self.MAX_LENGTH_DIGITS + 1)
+            if separator == -1:
+                if size - offset > self.MAX_LENGTH_DIGITS:
+                    return self.decode_error("Invalid netstring length", size)
+                break
+            length = data[offset:separator]
+            if not length.isdigit():
+                return self.decode_error("Invalid netstring length", size)
+            start = separator + 1
+            end = start + int(length, 10)
+            # Discard oversized netstrings without closing the connection
+            if end - start > self.MAX_BUFFER:
+                logging.warning("Discarding netstring of {} bytes".format(end - start))
+                self.skip = max(end + 1 - size, 0)
+                offset = min(end + 1, size)
+                self.string_too_long()
+                continue
+            # Then wait for the complete string and its trailing comma
+            if end >= size:
+                self.needed = end + 1 - offset
+                break
+            if data[end] != 0x2c:
+                return self.decode_error("Missing netstring terminator", size)
+            self.string_received(bytes(data[start:end]))
+            offset = end + 1
+        return offset
+
+    def decode_error(self, message, size):
+        """ The stream cannot be decoded anymore, close the connection
+        """
+        logging.warning(message)
+        self.transport.close()
+        return size
 
     def string_received(self, string):
         """ A new netstring was received
         """
         pass
 
+    def string_too_long(self):
+        """ A netstring longer than MAX_BUFFER was discarded
+        """
+        pass
+
     def send_string(self, string):
         """ Send a netstring
         """
         logging.debug("Replying {}".format(string))
-        self.transport.write(str(len(string)).encode('ascii'))
-        self.transport.write(b':')
-        self.transport.write(string)
-        self.transport.write(b',')
+        self.transport.write(b"%d:%s," % (len(string), string))
 
 
 class SocketmapProtocol(NetstringProtocol):
@@ -72,42 +116,108 @@ class SocketmapProtocol(NetstringProtocol):
     protocol.
 
     A table map must be provided as a dictionary to lookup tables.
+
+    Pipelined requests are looked up concurrently but answered in request
+    order. When too many lookups are outstanding on a connection, reading
+    from it is paused until replies are sent.
     """
 
+    # Maximum number of outstanding lookups per connection
+    MAX_PENDING = 64
+
     def __init__(self, table_map):
         self.table_map = table_map
+        # Replies (futures) in request order
+        self.replies = collections.deque()
+        self.paused = False
         super(SocketmapProtocol, self).__init__()
 
     def connection_made(self, transport):
         logging.info('Connect {}'.format(transport.get_extra_info('peername')))
         self.transport = transport
 
+    def connection_lost(self, exc):
+        for reply in self.replies:
+            reply.cancel()
+        self.replies.clear()
+
+    async def close(self):
+        """ Stop reading, send the replies to the running lookups, then close
+        the connection
+        """
+        # reading is not resumed when the lookups are done
+        self.paused = False
+        self.transport.pause_reading()
+        if self.replies:
+            await asyncio.wait(list(self.replies))
+        self.transport.close()
+
     def string_received(self, string):
         # The postfix format contains a space for separating the map name and
         # the key
         logging.debug("Received {}".format(string))
         space = string.find(0x20)
-        if space != -1:
+        try:
+            if space == -1:
+                raise ValueError(string)
             name = string[:space].decode('ascii')
             key = string[space+1:].decode('utf8')
-            return asyncio.ensure_future(self.process_request(name, key))
+        except ValueError:
+            logging.warning("Invalid request {}".format(string))
+            return self.queue_reply(b'PERM invalid request')
+        return self.queue_reply(self.process_request(name, key))
+
+    def string_too_long(self):
+        return self.queue_reply(b'PERM request too long')
+
+    def queue_reply(self, reply):
+        """ Queue a reply, either a string or a coroutine returning one
+        """
+        if asyncio.iscoroutine(reply):
+            future = asyncio.ensure_future(reply)
+        else:
+            future = asyncio.get_event_loop().create_future()
+            future.set_result(reply)
+        self.replies.append(future)
+        future.add_done_callback(self.flush_replies)
+        if len(self.replies) >= self.MAX_PENDING and not self.paused:
+            logging.debug("Too many pending requests, pause reading")
+            self.paused = True
+            self.transport.pause_reading()
+        return future
+
+    def flush_replies(self, _=None):
+        """ Send every reply that is ready, in request order
+        """
+        while self.replies and self.replies[0].done():
+            reply = self.replies.popleft()
+            if reply.cancelled() or self.transport.is_closing():
+                continue
+            if reply.exception() is not None:
+                logging.error("Error when processing request", exc_info=reply.exception())
+                self.send_string(b'TEMP unknown error')
+            else:
+                self.send_string(reply.result())
+        if self.paused and len(self.replies) < self.MAX_PENDING:
+            self.paused = False
+            self.transport.resume_reading()
 
     async def process_request(self, name, key):
-        """ Process a request by querying the provided map.
+        """ Process a request by querying the provided map, return the reply
         """
         logging.debug("Request {}/{}".format(name, key))
         try:
-            table = self.table_map.get(name)
+            table = self.table_map[name]
         except KeyError:
-            return self.send_string(b'TEMP no such map')
+            return b'TEMP no such map'
         try:
             result = await table.get(key)
-            return self.send_string(b'OK ' + str(result).encode('utf8'))
+            return b'OK ' + str(result).encode('utf8')
         except KeyError:
-            return self.send_string(b'NOTFOUND ')
+            return b'NOTFOUND '
         except Exception:
             logging.exception("Error when processing request")
-            return self.send_string(b'TEMP unknown error')
+            return b'TEMP unknown error'
 
     @classmethod
     def factory(cls, table_map):
@@ -0,0 +1,227 @@
+""" Mailu routing logic shared by the podop table backends
+
+Resolves the Mailu postfix maps the same way the admin endpoints in
+``mailu.internal.views.postfix`` and ``mailu.models`` do, given a source
+of Mailu records: any change to those must be reflected here.
+"""
+
+import os
+import re
+
+
+class Resolver(object):
+    """ Resolve the ``domain``, ``mailbox``, ``alias`` and ``transport``
+    maps, subclasses provide the record lookups.
+    """
+
+    MAPS = ("domain", "mailbox", "alias", "transport")
+
+    def domain(self, name):
+        """ Domain name (decoded) if the domain exists """
+        raise NotImplementedError()
+
+    def alternative(self, name):
+        """ Alternative name and domain name (decoded) if it exists """
+        raise NotImplementedError()
+
+    def user(self, email):
+        """ User email (decoded), forward_enabled, forward_destination (as a
+        list) and forward_keep if the user exists """
+        raise NotImplementedError()
+
+    def relay(self, name):
+        """ Relay name (decoded) and smtp target if the relay exists """
+        raise NotImplementedError()
+
+    def resolve_alias(self, localpart, domain_name):
+        """ See models.Alias.resolve, return (wildcard, destination list) """
+        raise NotImplementedError()
+
+    def lookup(self, name, key):
+        """ Resolve the key in the given map, None when not found """
+        return getattr(self, "lookup_" + name)(key)
+
+    def lookup_domain(self, domain_name):
+        if re.match(r'^\[.*\]$', domain_name):
+            return None
+        if domain := self.domain(domain_name):
+            return domain
+        if alternative := self.alternative(domain_name):
+            return alternative[0]
+        return None
+
+    def lookup_mailbox(self, email):
+        if user := self.user(email):
+            return user[0]
+        return None
+
+    def lookup_alias(self, alias):
+        localpart, domain_name = self.resolve_domain(alias)
+        if localpart is None:
+            return domain_name
+        if destinations := self.resolve_destination(localpart, domain_name):
+            return ",".join(idna_encode(destinations))
+        return None
+
+    def lookup_transport(self, email):
+        if email == '*' or re.match(r'(^|.*@)\[.*\]$', email):
+            return None
+        _, domain_name = self.resolve_domain(email)
+        relay = self.relay(domain_name)
+        if relay is None:
+            return None
+        return relay_transport(*relay)
+
+    def resolve_domain(self, email):
+        """ See models.Email.resolve_domain """
+        localpart, domain_name = email.rsplit('@', 1) if '@' in email else (None, email)
+        if alternative := self.alternative(domain_name):
+            domain_name = alternative[1]
+        return (localpart, domain_name)
+
+    def resolve_destination(self, localpart, domain_name, ignore_forward_keep=False):
+        """ See models.Email.resolve_destination """
+        localpart_stripped = None
+
+        if delims := os.environ.get('RECIPIENT_DELIMITER'):
+            try:
+                pos = next(i for i, c in enumerate(localpart) if c in delims)
+            except StopIteration:
+                pass
+            else:
+                localpart_stripped = localpart[:pos]
+
+        user = self.user(f'{localpart}@{domain_name}')
+        if not user and localpart_stripped:
+            user = self.user(f'{localpart_stripped}@{domain_name}')
+
+        if user:
+            email = f'{localpart}@{domain_name}'
+            _, forward_enabled, forward_destination, forward_keep = user
+
+            if not forward_enabled:
+                return [email]
+
+            destination = list(forward_destination)
+            if forward_keep or ignore_forward_keep:
+                destination.append(email)
+            return destination
+
+        if pure_alias := self.resolve_alias(localpart, domain_name):
+            wildcard, destination = pure_alias
+            if not wildcard:
+                return list(destination)
+
+        if stripped_alias := self.resolve_alias(localpart_stripped, domain_name):
+            return list(stripped_alias[1])
+
+        if pure_alias:
+            return list(pure_alias[1])
+
+        return None
+
+
+def idna_domain(name):
+    """ See models.IdnaDomain.process_bind_param """
+    import idna
+    return idna.encode(name.lower()).decode('ascii')
+
+
+def idna_email(email):
+    """ See models.IdnaEmail.process_bind_param """
+    import idna
+    if not '@' in email:
+        raise ValueError('invalid email address (no "@")')
+    localpart, domain_name = email.lower().rsplit('@', 1)
+    if '@' in localpart:
+        raise ValueError('email local part must not contain "@"')
+    return f'{localpart}@{idna.encode(domain_name).decode("ascii")}'
+
+
+def decode_domain(name):
+    """ See models.IdnaDomain.process_result_value """
+    import idna
+    return None if name is None else idna.decode(name)
+
+
+def decode_email(email):
+    """ See models.IdnaEmail.process_result_value """
+    import idna
+    localpart, domain_name = email.rsplit('@', 1)
+    return f'{localpart}@{idna.decode(domain_name)}'
+
+
+def split_list(value):
+    """ See models.CommaSeparatedList.process_result_value """
+    return list(filter(bool, (item.strip() for item in value.split(',')))) if value else []
+
+
+def idna_encode(addresses):
+    """ See mailu.internal.views.postfix.idna_encode """
+    import idna
+    return [
+        f"{localpart}@{idna.encode(domain).decode('ascii')}"
+        for (localpart, domain) in
+        (address.rsplit("@", 1) for address in addresses)
+    ]
+
+
+def relay_transport(name, smtp):
+    """ See mailu.models.Relay.parse_transport, invalid
+    targets raise a ValueError
+    """
+    import idna
+    target = (smtp or '').lower()
+    port = None
+    use_lmtp = False
+    use_mx = False
+    # strip prefixes mx: and lmtp:
+    if target.startswith('mx:'):
+        target = target[3:]
+        use_mx = True
+    elif target.startswith('lmtp:'):
+        target = target[5:]
+        use_lmtp = True
+    # split host:port or [host]:port
+    if target.startswith('['):
+        if use_mx or ']' not in target:
+            raise ValueError('invalid target (mx: and [] or missing ])')
+        host, rest = target[1:].split(']', 1)
+        if rest.startswith(':'):
+            port = rest[1:]
+        elif rest:
+            raise ValueError('invalid target (rest should be :port)')
+    else:
+        if ':' in target:
+            host, port = target.rsplit(':', 1)
+        else:
+            host = target
+    # default for empty host part is mx:domain
+    if not host:
+        if not use_lmtp:
+            host = name.lower()
+            use_mx = True
+        else:
+            raise ValueError('lmtp: needs a host part')
+    # detect ipv6 address or encode host
+    if ':' in host:
+        host = f'ipv6:{host}'
+    else:
+        try:
+            host = idna.encode(host).decode('ascii')
+        except idna.IDNAError:
+            raise ValueError('invalid host (fqdn not encodable)')
+    # validate port
+    if port is not None:
+        try:
+            port = int(port, 10)
+        except ValueError:
+            raise ValueError('invalid port (should be numeric)')
+    # create transport
+    transport = 'lmtp' if use_lmtp else 'smtp'
+    # use [] when not using MX lookups or host is an ipv6 address
+    if host.startswith('ipv6:') or (not use_lmtp and not use_mx):
+        host = f'[{host}]'
+    # create port suffix
+    port = '' if port is None else f':{port}'
+    return f'{transport}:{host}{port}'
@@ -0,0 +1,275 @@
+""" Routing snapshot table backend for podop
+
+Keeps an in-memory copy of the Mailu routing records (domains, alternatives,
+users, aliases and relays), fetched from the admin snapshot endpoints, and
+answers the Mailu postfix maps locally with the ``podop.routing`` logic.
+
+Admin exposes a version for every section of the snapshot, bumped whenever
+the matching records change. The snapshot polls those versions and only
+downloads the sections that changed.
+"""
+
+import asyncio
+import logging
+import re
+import time
+
+from podop import routing
+
+
+class Snapshot(object):
+    """ Routing records downloaded from a snapshot URL.
+
+    ``GET <url>`` must return a JSON object mapping every section name to
+    its current version, ``GET <url>/<section>`` a JSON object with the
+    ``version`` and the ``data`` rows of that section.
+    """
+
+    # Sections required by every map
+    SECTIONS = {
+        "domain": ("domain", "alternative"),
+        "mailbox": ("user",),
+        "alias": ("alternative", "user", "alias"),
+        "transport": ("alternative", "relay"),
+    }
+
+    # Time between two version checks, in seconds
+    POLL_INTERVAL = 5
+
+    # Time after which every section is downloaded again, in seconds, in case
+    # a change did not bump the version (bulk updates, manual SQL)
+    REFRESH_INTERVAL = 600
+
+    def __init__(self, url, pool):
+        self.url = url.rstrip("/")
+        self.pool = pool
+        self.sections = set()
+        self.versions = {}
+        self.resolver = SnapshotResolver()
+        self.refreshed = 0
+        self.ready = None
+        self.task = None
+
+    def require(self, name):
+        """ Make sure the sections of the given map are downloaded
+        """
+        self.sections.update(self.SECTIONS[name])
+
+    async def wait(self):
+        """ Wait until the snapshot is loaded, start polling on first use
+        """
+        if self.task is None:
+            self.ready = asyncio.get_event_loop().create_future()
+            self.task = asyncio.ensure_future(self.poll())
+        if not self.loaded():
+            await asyncio.shield(self.ready)
+        return self.resolver
+
+    async def poll(self):
+        """ Refresh the snapshot forever
+        """
+        while True:
+            try:
+                await self.refresh()
+            except Exception as error:
+                logging.exception("Unable to refresh the routing snapshot")
+                # Fail the pending lookups if nothing is loaded yet
+                if not self.ready.done():
+                    self.ready.set_exception(error)
+                    self.ready.exception()
+            else:
+                if not self.ready.done():
+                    self.ready.set_result(True)
+            if self.ready.done() and not self.loaded():
+                self.ready = asyncio.get_event_loop().create_future()
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+    def loaded(self):
+        """ Whether every required section was downloaded
+        """
+        return self.sections.issubset(self.versions)
+
+    async def refresh(self):
+        """ Download the sections whose version changed
+        """
+        session = await self.pool.open()
+        full = time.monotonic() - self.refreshed > self.REFRESH_INTERVAL
+        async with session.get(self.url) as request:
+            if request.status != 200:
+                raise Exception(request.status)
+            versions = await request.json()
+        for section in sorted(self.sections):
+            if not full and self.versions.get(section) == versions.get(section, ""):
+                continue
+            async with session.get(self.url + "/" + section) as request:
+                if request.status != 200:
+                    raise Exception(request.status)
+                result = await request.json()
+            self.resolver.load(section, result["data"])
+            self.versions[section] = result["version"]
+            logging.info("Loaded routing snapshot {} version {}".format(
+                section, result["version"]))
+        if full:
+            self.refreshed = time.monotonic()
+
+    async def close(self):
+        """ Stop polling
+        """
+        if self.task is not None:
+            task, self.task = self.task, None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+
+class SnapshotTable(object):
+    """ Resolve a Mailu postfix map from a routing snapshot.
+
+    The param is the snapshot URL followed by ``#`` and the map name, one of
+    ``domain``, ``mailbox``, ``alias`` or ``transport``.
+    """
+
+    # One snapshot per URL
+    snapshots = {}
+
+    def __init__(self, param, pool):
+        url, _, self.name = param.rpartition("#")
+        if self.name not in Snapshot.SECTIONS:
+            raise ValueError("Unknown snapshot map {}".format(self.name))
+        if url not in self.snapshots:
+            self.snapshots[url] = Snapshot(url, pool)
+        self.snapshot = self.snapshots[url]
+        self.snapshot.require(self.name)
+
+    @classmethod
+    async def close(cls):
+        """ Stop polling every snapshot
+        """
+        for snapshot in cls.snapshots.values():
+            await snapshot.close()
+        cls.snapshots.clear()
+
+    async def get(self, key, ns=None):
+        """ Get the given key, the namespace is not supported
+        """
+        logging.debug("Table get {}".format(key))
+        resolver = await self.snapshot.wait()
+        result = resolver.lookup(self.name, key)
+        if result is None:
+            raise KeyError()
+        logging.debug("Table get {} is {}".format(key, result))
+        return result
+
+
+class SnapshotResolver(routing.Resolver):
+    """ Mailu records indexed in memory, keyed like the database columns
+    """
+
+    def __init__(self):
+        self.domains = {}
+        self.alternatives = {}
+        self.users = {}
+        self.aliases = {}
+        self.relays = {}
+
+    def load(self, section, rows):
+        """ Replace the records of a section with the given rows
+        """
+        if section == "domain":
+            self.domains = {routing.idna_domain(name): name for name in rows}
+        elif section == "alternative":
+            self.alternatives = {
+                routing.idna_domain(name): (name, domain_name)
+                for name, domain_name in rows
+            }
+        elif section == "user":
+            self.users = {
+                routing.idna_email(row[0]): tuple(row) for row in rows
+            }
+        elif section == "alias":
+            aliases = {}
+            for domain_name, localpart, wildcard, destination in rows:
+                domain_name = routing.idna_domain(domain_name)
+                if domain_name not in aliases:
+                    aliases[domain_name] = AliasIndex()
+                aliases[domain_name].add(localpart, wildcard, destination)
+            for index in aliases.values():
+                index.sort()
+            self.aliases = aliases
+        elif section == "relay":
+            self.relays = {
+                routing.idna_domain(name): (name, smtp) for name, smtp in rows
+            }
+        else:
+            raise ValueError("Unknown snapshot section {}".format(section))
+
+    def domain(self, name):
+        return self.domains.get(routing.idna_domain(name))
+
+    def alternative(self, name):
+        return self.alternatives.get(routing.idna_domain(name))
+
+    def user(self, email):
+        return self.users.get(routing.idna_email(email))
+
+    def relay(self, name):
+        return self.relays.get(routing.idna_domain(name))
+
+    def resolve_alias(self, localpart, domain_name):
+        index = self.aliases.get(routing.idna_domain(domain_name))
+        if index is None or localpart is None:
+            return None
+        return index.resolve(localpart)
+
+
+class AliasIndex(object):
+    """ Aliases of a domain, with wildcards compiled to regular expressions
+    """
+
+    def __init__(self):
+        self.exact = {}
+        self.exact_lower = {}
+        self.wildcards = []
+        self.wildcards_lower = []
+
+    def add(self, localpart, wildcard, destination):
+        alias = (bool(wildcard), destination)
+        if wildcard:
+            self.wildcards.append((len(localpart), like(localpart), alias))
+            self.wildcards_lower.append(
+                (len(localpart.lower()), like(localpart.lower()), alias))
+        else:
+            self.exact.setdefault(localpart, alias)
+            self.exact_lower.setdefault(localpart.lower(), alias)
+
+    def sort(self):
+        """ Longest patterns first, like the ``char_length`` ordering
+        """
+        self.wildcards.sort(key=lambda item: -item[0])
+        self.wildcards_lower.sort(key=lambda item: -item[0])
+
+    def resolve(self, localpart):
+        """ See models.Alias.resolve, return (wildcard, destination list) """
+        alias_preserve_case = self.exact.get(localpart) or next(
+            (alias for _, regex, alias in self.wildcards if regex.fullmatch(localpart)),
+            None)
+        localpart_lower = localpart.lower()
+        alias_lower_case = self.exact_lower.get(localpart_lower) or next(
+            (alias for _, regex, alias in self.wildcards_lower
+             if regex.fullmatch(localpart_lower)),
+            None)
+
+        if alias_preserve_case and alias_lower_case:
+            return alias_lower_case if alias_preserve_case[0] else alias_preserve_case
+
+        return alias_preserve_case or alias_lower_case or None
+
+
+def like(pattern):
+    """ Compile a SQL ``LIKE`` pattern to a regular expression """
+    return re.compile("".join(
+        ".*" if char == "%" else "." if char == "_" else re.escape(char)
+        for char in pattern
+    ), re.DOTALL)
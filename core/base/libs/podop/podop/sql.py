@@ -0,0 +1,202 @@
+""" Direct database table backend for podop
+
+Answers the Mailu postfix maps straight from the Mailu database, without
+going through the admin HTTP API. The routing logic lives in
+``podop.routing``, shared with the snapshot backend.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+
+from podop import routing
+
+
+class SqlTable(object):
+    """ Resolve a Mailu postfix map by querying the Mailu database.
+
+    The param is the SQLAlchemy database URL followed by ``#`` and the map
+    name, one of ``domain``, ``mailbox``, ``alias`` or ``transport``.
+    """
+
+    # Number of pooled database connections (and query threads) per database
+    POOL_SIZE = 8
+
+    # One engine (connection pool) and executor per database URL
+    engines = {}
+
+    def __init__(self, param, pool=None):
+        url, _, self.name = param.rpartition("#")
+        if self.name not in routing.Resolver.MAPS:
+            raise ValueError("Unknown sql map {}".format(self.name))
+        self.engine, self.executor = self.get_engine(url)
+
+    @classmethod
+    def get_engine(cls, url):
+        """ Get the shared engine and executor for a database URL
+        """
+        if url not in cls.engines:
+            import sqlalchemy
+            engine = sqlalchemy.create_engine(
+                url, pool_size=cls.POOL_SIZE, pool_pre_ping=True
+            )
+            executor = concurrent.futures.ThreadPoolExecutor(cls.POOL_SIZE)
+            cls.engines[url] = engine, executor
+        return cls.engines[url]
+
+    @classmethod
+    async def close(cls):
+        """ Close every pooled connection
+        """
+        for engine, executor in cls.engines.values():
+            executor.shutdown()
+            engine.dispose()
+        cls.engines.clear()
+
+    async def get(self, key, ns=None):
+        """ Get the given key, the namespace is not supported
+        """
+        logging.debug("Table get {}".format(key))
+        loop = asyncio.get_event_loop()
+        result = await loop.run_in_executor(self.executor, self.run, key)
+        if result is None:
+            raise KeyError()
+        logging.debug("Table get {} is {}".format(key, result))
+        return result
+
+    def run(self, key):
+        """ Run the lookup on a pooled connection (in a worker thread)
+        """
+        with self.engine.connect() as connection:
+            return Lookup(connection).lookup(self.name, key)
+
+
+class Lookup(routing.Resolver):
+    """ Mailu model queries on a database connection
+    """
+
+    def __init__(self, connection):
+        import sqlalchemy
+        self.sql = sqlalchemy
+        self.connection = connection
+        self.tables = tables(sqlalchemy)
+
+    def domain(self, name):
+        domain = self.tables["domain"]
+        result = self.connection.execute(self.sql.select(domain.c.name).where(
+            domain.c.name == routing.idna_domain(name))).scalar()
+        return routing.decode_domain(result)
+
+    def alternative(self, name):
+        alternative = self.tables["alternative"]
+        result = self.connection.execute(
+            self.sql.select(alternative.c.name, alternative.c.domain_name).where(
+                alternative.c.name == routing.idna_domain(name))
+        ).first()
+        if result is None:
+            return None
+        return tuple(map(routing.decode_domain, result))
+
+    def user(self, email):
+        user = self.tables["user"]
+        result = self.connection.execute(
+            self.sql.select(user.c.email, user.c.forward_enabled,
+                user.c.forward_destination, user.c.forward_keep).where(
+                user.c.email == routing.idna_email(email))
+        ).first()
+        if result is None:
+            return None
+        email, forward_enabled, forward_destination, forward_keep = result
+        return (routing.decode_email(email), forward_enabled,
+                routing.split_list(forward_destination), forward_keep)
+
+    def relay(self, name):
+        relay = self.tables["relay"]
+        result = self.connection.execute(
+            self.sql.select(relay.c.name, relay.c.smtp).where(
+                relay.c.name == routing.idna_domain(name))
+        ).first()
+        if result is None:
+            return None
+        return routing.decode_domain(result[0]), result[1]
+
+    def resolve_alias(self, localpart, domain_name):
+        sql, alias = self.sql, self.tables["alias"]
+        domain_name = routing.idna_domain(domain_name)
+
+        alias_preserve_case = self.connection.execute(
+            sql.select(alias.c.wildcard, alias.c.destination).where(
+                sql.and_(alias.c.domain_name == domain_name,
+                    sql.or_(
+                        sql.and_(
+                            alias.c.wildcard == False,
+                            alias.c.localpart == localpart
+                        ), sql.and_(
+                            alias.c.wildcard == True,
+                            sql.bindparam('l', localpart).like(alias.c.localpart)
+                        )
+                    )
+                )
+            ).order_by(alias.c.wildcard, sql.func.char_length(alias.c.localpart).desc()).limit(1)
+        ).first()
+
+        localpart_lower = localpart.lower() if localpart else None
+        alias_lower_case = self.connection.execute(
+            sql.select(alias.c.wildcard, alias.c.destination).where(
+                sql.and_(alias.c.domain_name == domain_name,
+                    sql.or_(
+                        sql.and_(
+                            alias.c.wildcard == False,
+                            sql.func.lower(alias.c.localpart) == localpart_lower
+                        ), sql.and_(
+                            alias.c.wildcard == True,
+                            sql.bindparam('l', localpart_lower).like(
+                                sql.func.lower(alias.c.localpart))
+                        )
+                    )
+                )
+            ).order_by(alias.c.wildcard, sql.func.char_length(
+                sql.func.lower(alias.c.localpart)).desc()).limit(1)
+        ).first()
+
+        if alias_preserve_case and alias_lower_case:
+            result = alias_lower_case if alias_preserve_case[0] else alias_preserve_case
+        else:
+            result = alias_preserve_case or alias_lower_case
+        if result is None:
+            return None
+        return result[0], routing.split_list(result[1])
+
+
+_tables = None
+
+def tables(sqlalchemy):
+    """ Minimal description of the Mailu tables used for lookups
+    """
+    global _tables
+    if _tables is None:
+        metadata = sqlalchemy.MetaData()
+        column = sqlalchemy.Column
+        string = sqlalchemy.String
+        _tables = {
+            "domain": sqlalchemy.Table("domain", metadata,
+                column("name", string(80), primary_key=True)),
+            "alternative": sqlalchemy.Table("alternative", metadata,
+                column("name", string(80), primary_key=True),
+                column("domain_name", string(80))),
+            "relay": sqlalchemy.Table("relay", metadata,
+                column("name", string(80), primary_key=True),
+                column("smtp", string(80))),
+            "user": sqlalchemy.Table("user", metadata,
+                column("email", string(255), primary_key=True),
+                column("forward_enabled", sqlalchemy.Boolean),
+                column("forward_destination", string(4096)),
+                column("forward_keep", sqlalchemy.Boolean)),
+            "alias": sqlalchemy.Table("alias", metadata,
+                column("email", string(255), primary_key=True),
+                column("localpart", string(80)),
+                column("domain_name", string(80)),
+                column("wildcard", sqlalchemy.Boolean),
+                column("destination", string(4096))),
+        }
+    return _tables
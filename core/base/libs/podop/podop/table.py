@@ -2,19 +2,67 @@
 """
 
 import aiohttp
+import asyncio
+import collections
+import functools
+import json
 import logging
+import time
 from urllib.parse import quote
 
+
+class HttpPool(object):
+    """ Per-process pool of keep-alive HTTP connections, shared by every
+    url table so that a lookup does not pay for a new TCP connection.
+    """
+
+    def __init__(self, limit=100, limit_per_host=0, keepalive_timeout=30,
+                 connect_timeout=5, timeout=30):
+        """ ``limit`` and ``limit_per_host`` cap the number of simultaneous
+        connections (0 means unlimited), ``keepalive_timeout`` is how long an
+        idle connection is kept open, timeouts are expressed in seconds.
+        """
+        self.limit = int(limit)
+        self.limit_per_host = int(limit_per_host)
+        self.keepalive_timeout = float(keepalive_timeout)
+        self.timeout = aiohttp.ClientTimeout(
+            total=float(timeout), connect=float(connect_timeout)
+        )
+        self.session = None
+
+    async def open(self):
+        """ Open the underlying client session, must run inside the loop
+        """
+        if self.session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector, timeout=self.timeout
+            )
+        return self.session
+
+    async def close(self):
+        """ Close every pooled connection
+        """
+        if self.session is not None:
+            session, self.session = self.session, None
+            await session.close()
+
+
 class UrlTable(object):
     """ Resolve an entry by querying a parametrized GET URL.
     """
 
-    def __init__(self, url_pattern):
+    def __init__(self, url_pattern, pool):
         """ url_pattern must contain a format ``{}`` so the key is injected in
         the url before the query, the ``§`` character will be replaced with
         ``{}`` for easier setup.
         """
         self.url_pattern = url_pattern.replace('§', '{}')
+        self.pool = pool
 
     async def get(self, key, ns=None):
         """ Get the given key in the provided namespace
@@ -22,17 +70,17 @@ class UrlTable(object):
         logging.debug("Table get {}".format(key))
         if ns is not None:
             key += "/" + ns
-        async with aiohttp.ClientSession() as session:
-            quoted_key = quote(key)
-            async with session.get(self.url_pattern.format(quoted_key)) as request:
-                if request.status == 200:
-                    result = await request.json()
-                    logging.debug("Table get {} is {}".format(key, result))
-                    return result
-                elif request.status == 404:
-                    raise KeyError()
-                else:
-                    raise Exception(request.status)
+        session = await self.pool.open()
+        quoted_key = quote(key)
+        async with session.get(self.url_pattern.format(quoted_key)) as request:
+            if request.status == 200:
+                result = await request.json()
+                logging.debug("Table get {} is {}".format(key, result))
+                return result
+            elif request.status == 404:
+                raise KeyError()
+            else:
+                raise Exception(request.status)
 
     async def set(self, key, value, ns=None):
         """ Set a value for the given key in the provided namespace
@@ -40,16 +88,460 @@ class UrlTable(object):
         logging.debug("Table set {} to {}".format(key, value))
         if ns is not None:
             key += "/" + ns
-        async with aiohttp.ClientSession() as session:
-            quoted_key = quote(key)
-            await session.post(self.url_pattern.format(quoted_key), json=value)
+        session = await self.pool.open()
+        quoted_key = quote(key)
+        # Always consume the response so the connection goes back to the pool
+        async with session.post(self.url_pattern.format(quoted_key), json=value) as request:
+            await request.read()
 
     async def iter(self, cat):
         """ Iterate the given key (experimental)
         """
         logging.debug("Table iter {}".format(cat))
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.url_pattern.format(cat)) as request:
-                if request.status == 200:
-                    result = await request.json()
-                    return result
+        session = await self.pool.open()
+        async with session.get(self.url_pattern.format(cat)) as request:
+            if request.status == 200:
+                result = await request.json()
+                return result
+
+    async def iter_items(self, cat, max_rows=0):
+        """ Iterate the keys and values of the given key, at most
+        ``max_rows`` of them (0 means unlimited).
+
+        The URL is queried with a ``values`` parameter, and a ``limit`` one
+        when rows are limited, the response must be a stream of JSON
+        ``[key, value]`` pairs, one per line. Pairs are yielded as they are
+        received.
+        """
+        logging.debug("Table iter items {} max rows {}".format(cat, max_rows))
+        session = await self.pool.open()
+        params = {"values": "1"}
+        if max_rows > 0:
+            params["limit"] = str(max_rows)
+        # The response may be long, only time out while waiting for data
+        timeout = aiohttp.ClientTimeout(
+            total=None, connect=self.pool.timeout.connect,
+            sock_read=self.pool.timeout.total
+        )
+        url = self.url_pattern.format(cat)
+        async with session.get(url, params=params, timeout=timeout) as request:
+            if request.status == 404:
+                raise KeyError()
+            elif request.status != 200:
+                raise Exception(request.status)
+            async for line in request.content:
+                if line.strip():
+                    key, value = json.loads(line)
+                    yield key, value
+
+
+class HttpBatch(object):
+    """ Group the lookups that arrive within a few milliseconds in a single
+    POST request to a batch URL.
+
+    The request body is a JSON list of ``[map, key]`` pairs, the response
+    must be a JSON list of ``[status, value]`` pairs in the same order,
+    where status has the same meaning as for a url table.
+    """
+
+    # Time to wait for more lookups before sending a batch, in seconds
+    DELAY = 0.002
+
+    # Maximum number of lookups in a batch
+    SIZE = 100
+
+    def __init__(self, url, pool):
+        self.url = url
+        self.pool = pool
+        self.queue = []
+        self.handle = None
+
+    def lookup(self, name, key):
+        """ Queue a lookup, return a future for its result
+        """
+        future = asyncio.get_event_loop().create_future()
+        self.queue.append((name, key, future))
+        if len(self.queue) >= self.SIZE:
+            self.flush()
+        elif self.handle is None:
+            self.handle = asyncio.get_event_loop().call_later(self.DELAY, self.flush)
+        return future
+
+    def flush(self):
+        """ Send the queued lookups
+        """
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        queue, self.queue = self.queue, []
+        if queue:
+            asyncio.ensure_future(self.send(queue))
+
+    async def send(self, queue):
+        """ Send a batch and resolve the matching futures
+        """
+        logging.debug("Table batch of {} lookups".format(len(queue)))
+        try:
+            session = await self.pool.open()
+            lookups = [[name, key] for name, key, _ in queue]
+            async with session.post(self.url, json=lookups) as request:
+                if request.status != 200:
+                    raise Exception(request.status)
+                results = await request.json()
+            if len(results) != len(queue):
+                raise Exception("{} results for {} lookups".format(len(results), len(queue)))
+        except Exception as error:
+            for _, _, future in queue:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for (_, _, future), (status, value) in zip(queue, results):
+            if future.done():
+                continue
+            if status == 200:
+                future.set_result(value)
+            elif status == 404:
+                future.set_exception(KeyError())
+            else:
+                future.set_exception(Exception(status))
+
+
+class BatchTable(object):
+    """ Send the lookups of a table through a shared ``HttpBatch``, other
+    operations are handled by the underlying table.
+    """
+
+    def __init__(self, table, name, batch):
+        self.table = table
+        self.name = name
+        self.batch = batch
+
+    async def get(self, key, ns=None):
+        """ Get the given key in the provided namespace
+        """
+        logging.debug("Table batch get {}".format(key))
+        if ns is not None:
+            key += "/" + ns
+        return await self.batch.lookup(self.name, key)
+
+    async def set(self, key, value, ns=None):
+        """ Set the key in the underlying table
+        """
+        return await self.table.set(key, value, ns=ns)
+
+    async def iter(self, cat):
+        """ Iterate the underlying table
+        """
+        return await self.table.iter(cat)
+
+    def iter_items(self, cat, max_rows=0):
+        """ Iterate the underlying table
+        """
+        return self.table.iter_items(cat, max_rows)
+
+
+class WriteBehindTable(object):
+    """ Merge the sets of a table in memory and write them in periodic
+    batches to a bulk URL, other operations are handled by the underlying
+    table.
+
+    Only the last value set for a key is written. The request body is a
+    JSON list of ``[key, value]`` pairs, where the key has the namespace
+    appended as for a url table.
+    """
+
+    # Maximum time a value is kept in memory before being written, in seconds
+    DELAY = 5
+
+    def __init__(self, table, url, pool, delay=DELAY):
+        self.table = table
+        self.url = url
+        self.pool = pool
+        self.delay = float(delay)
+        self.pending = {}
+        self.handle = None
+        self.task = None
+
+    async def get(self, key, ns=None):
+        """ Get the given key, values not written yet are returned first
+        """
+        pending_key = key if ns is None else key + "/" + ns
+        if pending_key in self.pending:
+            return self.pending[pending_key]
+        return await self.table.get(key, ns=ns)
+
+    async def set(self, key, value, ns=None):
+        """ Set the given key in memory, it is written on next flush
+        """
+        logging.debug("Table write behind {} to {}".format(key, value))
+        if ns is not None:
+            key += "/" + ns
+        self.pending[key] = value
+        self.schedule()
+
+    async def iter(self, cat):
+        """ Iterate the underlying table
+        """
+        return await self.table.iter(cat)
+
+    def iter_items(self, cat, max_rows=0):
+        """ Iterate the underlying table
+        """
+        return self.table.iter_items(cat, max_rows)
+
+    def schedule(self):
+        """ Make sure a flush is scheduled
+        """
+        if self.handle is None:
+            self.handle = asyncio.get_event_loop().call_later(self.delay, self.flush)
+
+    def flush(self):
+        """ Write the pending values, one batch at a time so that an older
+        value never overwrites a newer one
+        """
+        self.handle = None
+        if self.task is not None and not self.task.done():
+            return self.schedule()
+        pending, self.pending = self.pending, {}
+        if pending:
+            self.task = asyncio.ensure_future(self.send(pending))
+
+    async def send(self, pending):
+        """ Send a batch of values, keep them for the next flush on error
+        """
+        logging.debug("Table write behind batch of {} values".format(len(pending)))
+        try:
+            session = await self.pool.open()
+            values = [[key, value] for key, value in pending.items()]
+            async with session.post(self.url, json=values) as request:
+                await request.read()
+                if request.status != 200:
+                    raise Exception(request.status)
+        except Exception:
+            logging.exception("Unable to write {} values".format(len(pending)))
+            for key, value in pending.items():
+                self.pending.setdefault(key, value)
+            self.schedule()
+
+    async def close(self):
+        """ Write every pending value
+        """
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.task is not None:
+            await self.task
+        pending, self.pending = self.pending, {}
+        if pending:
+            await self.send(pending)
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+
+class SingleFlightTable(object):
+    """ Share a single lookup between identical concurrent requests.
+
+    In-flight lookups are indexed by key and namespace, any request for a
+    key that is already being looked up awaits the same future instead of
+    querying the underlying table again.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.pending = {}
+
+    async def get(self, key, ns=None):
+        """ Get the given key, joining an identical in-flight lookup
+        """
+        pending_key = (key, ns)
+        future = self.pending.get(pending_key)
+        if future is None:
+            future = asyncio.ensure_future(self.table.get(key, ns=ns))
+            self.pending[pending_key] = future
+            future.add_done_callback(functools.partial(self.done, pending_key))
+        else:
+            logging.debug("Table get {} joins a pending lookup".format(key))
+        # Do not let a cancelled caller cancel the lookup shared by others
+        return await asyncio.shield(future)
+
+    def done(self, pending_key, future):
+        """ Forget a finished lookup
+        """
+        del self.pending[pending_key]
+        # Mark the exception as retrieved in case every caller went away
+        if not future.cancelled():
+            future.exception()
+
+    async def set(self, key, value, ns=None):
+        """ Set the key in the underlying table
+        """
+        return await self.table.set(key, value, ns=ns)
+
+    async def iter(self, cat):
+        """ Iterate the underlying table
+        """
+        return await self.table.iter(cat)
+
+    def iter_items(self, cat, max_rows=0):
+        """ Iterate the underlying table
+        """
+        return self.table.iter_items(cat, max_rows)
+
+
+class CachedTable(object):
+    """ Cache lookups of another table in a bounded LRU, with separate
+    time-to-live for found (positive) and missing (negative) keys.
+
+    Only ``get`` is cached, tables with side effects must not be wrapped.
+    Wrap a ``SingleFlightTable`` so that concurrent misses for the same key
+    share a single upstream lookup.
+    """
+
+    def __init__(self, table, ttl=60, negative_ttl=None, size=10000, version=None):
+        """ ``ttl`` and ``negative_ttl`` are expressed in seconds, a null
+        value disables caching of the matching results, ``negative_ttl``
+        defaults to ``ttl``. ``size`` is the maximum number of cached keys.
+        ``version`` is an optional ``VersionWatch``, the whole cache is
+        dropped whenever the watched version changes.
+        """
+        self.table = table
+        self.ttl = float(ttl)
+        self.negative_ttl = self.ttl if negative_ttl is None else float(negative_ttl)
+        self.size = int(size)
+        self.cache = collections.OrderedDict()
+        # Bumped on clear, so that lookups started before are not stored
+        self.generation = 0
+        self.version = version
+        if version is not None:
+            version.listeners.append(self.clear)
+
+    def clear(self):
+        """ Drop every cached result
+        """
+        logging.debug("Table cache cleared")
+        self.cache.clear()
+        self.generation += 1
+
+    async def get(self, key, ns=None):
+        """ Get the given key from cache, or from the table on cache miss
+        """
+        if self.version is not None:
+            self.version.start()
+        cache_key = (key, ns)
+        entry = self.cache.get(cache_key)
+        if entry is not None:
+            expires, found, value = entry
+            if expires > time.monotonic():
+                logging.debug("Table cache hit {}".format(key))
+                self.cache.move_to_end(cache_key)
+                if found:
+                    return value
+                raise KeyError()
+            del self.cache[cache_key]
+        generation = self.generation
+        try:
+            value = await self.table.get(key, ns=ns)
+        except KeyError:
+            self.store(cache_key, False, None, self.negative_ttl, generation)
+            raise
+        self.store(cache_key, True, value, self.ttl, generation)
+        return value
+
+    def store(self, cache_key, found, value, ttl, generation):
+        """ Store a result, evicting the least recently used entries, unless
+        the cache was cleared since the lookup started
+        """
+        if ttl <= 0 or generation != self.generation:
+            return
+        self.cache[cache_key] = (time.monotonic() + ttl, found, value)
+        self.cache.move_to_end(cache_key)
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+    async def set(self, key, value, ns=None):
+        """ Set the key in the underlying table and drop the cached value
+        """
+        self.cache.pop((key, ns), None)
+        return await self.table.set(key, value, ns=ns)
+
+    async def iter(self, cat):
+        """ Iterate the underlying table, this is never cached
+        """
+        return await self.table.iter(cat)
+
+    def iter_items(self, cat, max_rows=0):
+        """ Iterate the underlying table, this is never cached
+        """
+        return self.table.iter_items(cat, max_rows)
+
+
+class VersionWatch(object):
+    """ Poll a JSON object of versions and notify the listeners whenever the
+    watched version changes, so that cached results can be dropped.
+
+    The param is the version URL followed by ``#`` and the key of the watched
+    version in the returned object. Polling starts on first use.
+    """
+
+    # Time between two version checks, in seconds
+    POLL_INTERVAL = 5
+
+    # One watch per param
+    watches = {}
+
+    def __init__(self, param, pool):
+        self.url, _, self.key = param.rpartition("#")
+        self.pool = pool
+        self.current = None
+        self.listeners = []
+        self.task = None
+
+    @classmethod
+    def get(cls, param, pool):
+        """ Get the shared watch for a param
+        """
+        if param not in cls.watches:
+            cls.watches[param] = cls(param, pool)
+        return cls.watches[param]
+
+    @classmethod
+    async def close(cls):
+        """ Stop polling every watch
+        """
+        for watch in cls.watches.values():
+            if watch.task is not None:
+                task, watch.task = watch.task, None
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        cls.watches.clear()
+
+    def start(self):
+        """ Start polling if not started yet
+        """
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.poll())
+
+    async def poll(self):
+        """ Check the version forever, a failed check keeps the listeners
+        untouched
+        """
+        while True:
+            try:
+                session = await self.pool.open()
+                async with session.get(self.url) as request:
+                    if request.status != 200:
+                        raise Exception(request.status)
+                    version = (await request.json()).get(self.key)
+            except Exception:
+                logging.exception("Unable to check version {}".format(self.url))
+            else:
+                if version != self.current:
+                    logging.debug("Version {} changed to {}".format(self.key, version))
+                    self.current = version
+                    for listener in self.listeners:
+                        listener()
+            await asyncio.sleep(self.POLL_INTERVAL)
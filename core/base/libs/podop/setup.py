@@ -19,5 +19,8 @@ setup(
     scripts=["scripts/podop"],
     install_requires=[
         "aiohttp"
-    ]
+    ],
+    extras_require={
+        "sql": ["SQLAlchemy", "idna"]
+    }
 )
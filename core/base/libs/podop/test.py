@@ -0,0 +1,565 @@
+import asyncio
+import json
+import random
+import unittest
+
+from podop import dovecot, postfix, snapshot, table
+
+
+class FakeTransport(object):
+    """ Collect written data instead of sending it
+    """
+
+    def __init__(self):
+        self.written = b""
+        self.closed = False
+        self.paused = False
+
+    def write(self, data):
+        self.written += data
+
+    def close(self):
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+
+class CollectingProtocol(postfix.NetstringProtocol):
+    """ Netstring protocol that stores decoded strings
+    """
+
+    MAX_BUFFER = 16
+
+    def __init__(self):
+        super(CollectingProtocol, self).__init__()
+        self.transport = FakeTransport()
+        self.strings = []
+        self.too_long = 0
+
+    def string_received(self, string):
+        self.strings.append(string)
+
+    def string_too_long(self):
+        self.too_long += 1
+
+
+class TestNetstring(unittest.TestCase):
+    """ Test the netstring decoder
+    """
+
+    def test_pipelined(self):
+        protocol = CollectingProtocol()
+        protocol.data_received(b"5:hello,0:,3:foo,")
+        self.assertEqual(protocol.strings, [b"hello", b"", b"foo"])
+        self.assertEqual(protocol.buffer, b"")
+
+    def test_split(self):
+        protocol = CollectingProtocol()
+        stream = b"5:hello,11:hello world,3:foo,"
+        for index in range(len(stream)):
+            protocol.data_received(stream[index:index + 1])
+        self.assertEqual(protocol.strings, [b"hello", b"hello world", b"foo"])
+        self.assertEqual(protocol.buffer, b"")
+
+    def test_partial_tail(self):
+        protocol = CollectingProtocol()
+        protocol.data_received(b"3:foo,5:hel")
+        self.assertEqual(protocol.strings, [b"foo"])
+        protocol.data_received(bytearray(b"lo,1:a,"))
+        self.assertEqual(protocol.strings, [b"foo", b"hello", b"a"])
+
+    def test_too_long(self):
+        protocol = CollectingProtocol()
+        protocol.data_received(b"3:foo,20:0123456789")
+        protocol.data_received(b"0123456789,3:bar,")
+        self.assertEqual(protocol.strings, [b"foo", b"bar"])
+        self.assertEqual(protocol.too_long, 1)
+        self.assertFalse(protocol.transport.closed)
+
+    def test_invalid(self):
+        protocol = CollectingProtocol()
+        protocol.data_received(b"3:foo,x:bar,3:baz,")
+        self.assertEqual(protocol.strings, [b"foo"])
+        self.assertTrue(protocol.transport.closed)
+        protocol = CollectingProtocol()
+        protocol.data_received(b"3:foox")
+        self.assertTrue(protocol.transport.closed)
+
+    def test_send(self):
+        protocol = CollectingProtocol()
+        protocol.send_string(b"OK foo")
+        self.assertEqual(protocol.transport.written, b"6:OK foo,")
+
+
+class SleepyTable(object):
+    """ Table answering keys after sleeping for as many milliseconds
+    """
+
+    async def get(self, key, ns=None):
+        await asyncio.sleep(int(key) / 1000)
+        if key == "0":
+            raise KeyError()
+        return key
+
+
+class TestSingleFlightTable(unittest.TestCase):
+    """ Test the coalescing of identical concurrent lookups
+    """
+
+    def test_coalesce(self):
+        async def run():
+            upstream = CountingSleepyTable()
+            coalesced = table.SingleFlightTable(upstream)
+            results = await asyncio.gather(
+                coalesced.get("10"), coalesced.get("10"), coalesced.get("10", ns="user"),
+                coalesced.get("0"), coalesced.get("0"), return_exceptions=True
+            )
+            await coalesced.get("10")
+            return upstream.count, results, coalesced.pending
+        count, results, pending = asyncio.run(run())
+        self.assertEqual(count, 4)
+        self.assertEqual(results[:3], ["10", "10", "10"])
+        self.assertIsInstance(results[3], KeyError)
+        self.assertIsInstance(results[4], KeyError)
+        self.assertEqual(pending, {})
+
+    def test_cancel(self):
+        async def run():
+            coalesced = table.SingleFlightTable(CountingSleepyTable())
+            first = asyncio.ensure_future(coalesced.get("10"))
+            second = asyncio.ensure_future(coalesced.get("10"))
+            await asyncio.sleep(0)
+            first.cancel()
+            return await second
+        self.assertEqual(asyncio.run(run()), "10")
+
+
+class TestSocketmap(unittest.TestCase):
+    """ Test the socketmap protocol
+    """
+
+    def request(self, protocol, *requests):
+        for request in requests:
+            protocol.data_received(b"%d:%s," % (len(request), request))
+
+    def test_ordered_replies(self):
+        async def run():
+            protocol = postfix.SocketmapProtocol({"sleepy": SleepyTable()})
+            protocol.transport = FakeTransport()
+            self.request(protocol, b"sleepy 30", b"sleepy 0", b"other 1",
+                         b"invalid", b"sleepy 10")
+            await asyncio.gather(*protocol.replies)
+            return protocol.transport.written
+        self.assertEqual(asyncio.run(run()), b"".join([
+            b"5:OK 30,", b"9:NOTFOUND ,", b"16:TEMP no such map,",
+            b"20:PERM invalid request,", b"5:OK 10,"
+        ]))
+
+    def test_backpressure(self):
+        async def run():
+            protocol = postfix.SocketmapProtocol({"sleepy": SleepyTable()})
+            protocol.transport = FakeTransport()
+            self.request(protocol, *[b"sleepy 10"] * protocol.MAX_PENDING)
+            paused = protocol.transport.paused
+            await asyncio.gather(*protocol.replies)
+            return paused, protocol.transport.paused
+        self.assertEqual(asyncio.run(run()), (True, False))
+
+    def test_close(self):
+        async def run():
+            protocol = postfix.SocketmapProtocol({"sleepy": SleepyTable()})
+            protocol.transport = FakeTransport()
+            self.request(protocol, b"sleepy 20", b"sleepy 10")
+            await protocol.close()
+            return protocol.transport.paused, protocol.transport.closed, protocol.transport.written
+        self.assertEqual(asyncio.run(run()), (True, True, b"5:OK 20,5:OK 10,"))
+
+
+class CountingSleepyTable(SleepyTable):
+    """ Sleepy table counting the lookups it answers
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    async def get(self, key, ns=None):
+        self.count += 1
+        return await super(CountingSleepyTable, self).get(key, ns)
+
+
+class MemoryTable(SleepyTable):
+    """ Sleepy table that also stores the values it is set
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    async def set(self, key, value, ns=None):
+        self.values[(key, ns)] = value
+
+
+class TestDict(unittest.TestCase):
+    """ Test the dovecot dict protocol
+    """
+
+    HELLO = b"H3\t3\t0\tuser@example.com\ttest\n"
+
+    def connect(self, table):
+        protocol = dovecot.DictProtocol({"test": table})
+        protocol.transport = FakeTransport()
+        return protocol
+
+    def feed(self, protocol, stream, chunks):
+        """ Feed the stream in the given number of randomly split reads """
+        cuts = sorted(random.sample(range(1, len(stream)), chunks - 1))
+        for start, end in zip([0] + cuts, cuts + [len(stream)]):
+            protocol.data_received(stream[start:end])
+
+    def test_ordered_replies(self):
+        async def run():
+            protocol = self.connect(SleepyTable())
+            self.feed(protocol, self.HELLO + b"Lshared/30\nLshared/0\nLshared/10\n", 7)
+            await asyncio.gather(*protocol.pending)
+            return protocol.transport.written
+        self.assertEqual(asyncio.run(run()), b"O30\nN\nO10\n")
+
+    def test_commit_batch(self):
+        random.seed(0)
+        key = dovecot.tabescape(b"priv/tab\tkey")
+        sets = b"".join(
+            b"S1\t%s%d\t%d\n" % (key, index, index) for index in range(1000)
+        )
+        stream = self.HELLO + b"B1\t\n" + sets + b"C1\n"
+        async def run(chunks):
+            table = MemoryTable()
+            protocol = self.connect(table)
+            self.feed(protocol, stream, chunks)
+            await asyncio.gather(*protocol.pending)
+            return table.values, protocol.transport.written
+        for chunks in (1, 2, 100, 5000):
+            values, written = asyncio.run(run(chunks))
+            self.assertEqual(len(values), 1000)
+            self.assertEqual(values[("tab\tkey999", "user@example.com")], 999)
+            self.assertEqual(written, b"O1\n")
+
+    def test_backpressure(self):
+        async def run():
+            protocol = self.connect(SleepyTable())
+            protocol.data_received(self.HELLO + b"Lshared/10\n" * protocol.MAX_PENDING)
+            paused = protocol.transport.paused
+            await asyncio.gather(*protocol.pending)
+            return paused, protocol.transport.paused, protocol.transport.written
+        paused, resumed, written = asyncio.run(run())
+        self.assertEqual((paused, resumed), (True, False))
+        self.assertEqual(written, b"O10\n" * dovecot.DictProtocol.MAX_PENDING)
+
+    def test_close(self):
+        async def run():
+            protocol = self.connect(MemoryTable())
+            protocol.data_received(self.HELLO + b"Lshared/20\nB1\t\nS1\tpriv/key\t1\nC1\n")
+            await protocol.close()
+            return protocol.dict.values, protocol.transport.paused, protocol.transport.closed, protocol.transport.written
+        values, paused, closed, written = asyncio.run(run())
+        self.assertEqual(values, {("key", "user@example.com"): 1})
+        self.assertEqual((paused, closed, written), (True, True, b"O20\nO1\n"))
+
+
+class FakeResponse(object):
+    """ Canned HTTP response, usable as an async context manager
+    """
+
+    def __init__(self, status, body=None):
+        self.status = status
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def read(self):
+        return json.dumps(self.body).encode("utf8")
+
+    async def json(self):
+        return self.body
+
+    @property
+    async def content(self):
+        """ Stream the body rows, one JSON line each """
+        for row in self.body:
+            yield json.dumps(row).encode("utf8") + b"\n"
+
+
+class FakePool(object):
+    """ HTTP pool recording requests and answering them with a callback
+    """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+        self.timeout = table.HttpPool().timeout
+
+    async def open(self):
+        return self
+
+    def post(self, url, json=None):
+        self.requests.append((url, json))
+        return self.respond(url, json)
+
+    def get(self, url, params=None, timeout=None):
+        self.requests.append((url, params))
+        return self.respond(url, params)
+
+
+class TestIterItems(unittest.TestCase):
+    """ Test the streamed iterations
+    """
+
+    URL = "http://admin/internal/dovecot/§"
+
+    def test_url_table(self):
+        async def run(status, max_rows):
+            pool = FakePool(lambda url, params: FakeResponse(status, [
+                ["a@example.com", {"quota": 1}], ["b@example.com", {"quota": 2}]
+            ]))
+            url = table.UrlTable(self.URL, pool)
+            try:
+                rows = [row async for row in url.iter_items("userdb/", max_rows)]
+            except KeyError:
+                rows = None
+            return pool.requests, rows
+        requests, rows = asyncio.run(run(200, 0))
+        self.assertEqual(requests, [("http://admin/internal/dovecot/userdb/", {"values": "1"})])
+        self.assertEqual(rows, [("a@example.com", {"quota": 1}), ("b@example.com", {"quota": 2})])
+        requests, rows = asyncio.run(run(200, 2))
+        self.assertEqual(requests[0][1], {"values": "1", "limit": "2"})
+        requests, rows = asyncio.run(run(404, 0))
+        self.assertIsNone(rows)
+
+    def test_dict_iterate(self):
+        async def run():
+            pool = FakePool(lambda url, params: FakeResponse(200, [
+                ["a@example.com", {"quota": 1}], ["b@example.com", {"quota": 2}]
+            ]))
+            wrapped = table.CachedTable(table.SingleFlightTable(table.UrlTable(self.URL, pool)))
+            protocol = dovecot.DictProtocol({"auth": wrapped})
+            protocol.transport = FakeTransport()
+            protocol.data_received(b"H3\t3\t0\t\tauth\nI0\t2\tshared/userdb/\n")
+            await asyncio.gather(*protocol.pending)
+            return protocol.transport.written
+        self.assertEqual(asyncio.run(run()), b"".join([
+            b'Oshared/userdb/a@example.com\t{"quota": 1}\n',
+            b'Oshared/userdb/b@example.com\t{"quota": 2}\n',
+            b"\n"
+        ]))
+
+
+class TestHttpBatch(unittest.TestCase):
+    """ Test the batched lookups
+    """
+
+    URL = "http://admin/internal/postfix/batch"
+
+    def lookup(self, respond, *keys):
+        async def run():
+            pool = FakePool(respond)
+            batch = table.HttpBatch(self.URL, pool)
+            results = await asyncio.gather(
+                *(table.BatchTable(None, name, batch).get(key) for name, key in keys),
+                return_exceptions=True
+            )
+            return pool.requests, results
+        return asyncio.run(run())
+
+    def test_batch(self):
+        requests, results = self.lookup(
+            lambda url, body: FakeResponse(200, [
+                [200, "found"], [404, None], [500, None]
+            ]),
+            ("alias", "a@example.com"), ("domain", "example.org"), ("alias", "b@example.com")
+        )
+        self.assertEqual(requests, [(self.URL, [
+            ["alias", "a@example.com"], ["domain", "example.org"], ["alias", "b@example.com"]
+        ])])
+        self.assertEqual(results[0], "found")
+        self.assertIsInstance(results[1], KeyError)
+        self.assertEqual(results[2].args, (500,))
+
+    def test_missing_results(self):
+        requests, results = self.lookup(
+            lambda url, body: FakeResponse(200, [[200, "found"]]),
+            ("alias", "a@example.com"), ("alias", "b@example.com")
+        )
+        self.assertEqual(len(requests), 1)
+        self.assertTrue(all(isinstance(result, Exception) for result in results))
+
+    def test_size(self):
+        requests, results = self.lookup(
+            lambda url, body: FakeResponse(200, [[200, key] for _, key in body]),
+            *(("alias", str(index)) for index in range(table.HttpBatch.SIZE + 1))
+        )
+        self.assertEqual([len(body) for _, body in requests], [table.HttpBatch.SIZE, 1])
+        self.assertEqual(results, [str(index) for index in range(table.HttpBatch.SIZE + 1)])
+
+
+class TestWriteBehindTable(unittest.TestCase):
+    """ Test the write-behind table
+    """
+
+    URL = "http://admin/internal/dovecot/quota"
+
+    def test_dict_commit(self):
+        async def run():
+            pool = FakePool(lambda url, body: FakeResponse(200))
+            writer = table.WriteBehindTable(MemoryTable(), self.URL, pool)
+            protocol = dovecot.DictProtocol({"quota": writer})
+            protocol.transport = FakeTransport()
+            protocol.data_received(
+                b"H3\t3\t0\tuser@example.com\tquota\n"
+                b"B1\t\nS1\tpriv/quota/storage\t123\nS1\tpriv/quota/messages\t4\nC1\n"
+            )
+            await asyncio.gather(*protocol.pending)
+            await writer.close()
+            return pool.requests
+        self.assertEqual(asyncio.run(run()), [(self.URL, [
+            ["quota/storage/user@example.com", 123],
+            ["quota/messages/user@example.com", 4],
+        ])])
+
+    def test_last_value(self):
+        async def run():
+            pool = FakePool(lambda url, body: FakeResponse(200))
+            writer = table.WriteBehindTable(MemoryTable(), self.URL, pool)
+            await writer.set("quota/storage", 1, ns="user@example.com")
+            await writer.set("quota/storage", 2, ns="user@example.com")
+            pending = await writer.get("quota/storage", ns="user@example.com")
+            await writer.close()
+            return pending, pool.requests
+        pending, requests = asyncio.run(run())
+        self.assertEqual(pending, 2)
+        self.assertEqual(requests, [(self.URL, [["quota/storage/user@example.com", 2]])])
+
+    def test_retry(self):
+        async def run():
+            statuses = [500]
+            pool = FakePool(lambda url, body: FakeResponse(statuses.pop(0) if statuses else 200))
+            writer = table.WriteBehindTable(MemoryTable(), self.URL, pool, delay=0.01)
+            await writer.set("quota/storage", 1, ns="user@example.com")
+            await asyncio.sleep(0.05)
+            await writer.set("quota/storage", 2, ns="other@example.com")
+            await writer.close()
+            return pool.requests, writer.pending
+        requests, pending = asyncio.run(run())
+        # the failed value is written again with the next batch
+        self.assertEqual(requests[0][1], [["quota/storage/user@example.com", 1]])
+        self.assertEqual(sorted(row for _, body in requests[1:] for row in body), [
+            ["quota/storage/other@example.com", 2], ["quota/storage/user@example.com", 1]
+        ])
+        self.assertEqual(pending, {})
+
+
+class CountingTable(object):
+    """ Table counting the lookups it answers
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    async def get(self, key, ns=None):
+        self.count += 1
+        return key
+
+
+class FakeWatch(object):
+    """ Version watch that is only changed by hand
+    """
+
+    def __init__(self):
+        self.listeners = []
+
+    def start(self):
+        pass
+
+    def change(self):
+        for listener in self.listeners:
+            listener()
+
+
+class TestCachedTable(unittest.TestCase):
+    """ Test the cached table invalidation
+    """
+
+    def test_version(self):
+        async def run():
+            upstream, watch = CountingTable(), FakeWatch()
+            cached = table.CachedTable(upstream, ttl=300, version=watch)
+            await cached.get("user@example.com")
+            await cached.get("user@example.com")
+            before = upstream.count
+            watch.change()
+            await cached.get("user@example.com")
+            return before, upstream.count
+        self.assertEqual(asyncio.run(run()), (1, 2))
+
+    def test_version_during_lookup(self):
+        async def run():
+            upstream, watch = SleepyTable(), FakeWatch()
+            cached = table.CachedTable(upstream, ttl=300, version=watch)
+            lookup = asyncio.ensure_future(cached.get("10"))
+            await asyncio.sleep(0)
+            watch.change()
+            await lookup
+            return len(cached.cache)
+        self.assertEqual(asyncio.run(run()), 0)
+
+
+class TestSnapshotResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.resolver = snapshot.SnapshotResolver()
+        self.resolver.load("domain", ["example.com"])
+        self.resolver.load("alternative", [["alt.com", "example.com"]])
+        self.resolver.load("user", [
+            ["bob@example.com", False, [], True],
+            ["fwd@example.com", True, ["x@ext.org"], False],
+        ])
+        self.resolver.load("alias", [
+            ["example.com", "team", False, ["bob@example.com"]],
+            ["example.com", "Mixed", False, ["mixed@example.com"]],
+            ["example.com", "sales%", True, ["sales@example.com"]],
+            ["example.com", "%", True, ["catchall@example.com"]],
+        ])
+        self.resolver.load("relay", [["relay.org", "[1.2.3.4]:26"], ["mx.org", None]])
+
+    def test_domain(self):
+        self.assertEqual(self.resolver.lookup("domain", "EXAMPLE.com"), "example.com")
+        self.assertEqual(self.resolver.lookup("domain", "alt.com"), "alt.com")
+        self.assertIsNone(self.resolver.lookup("domain", "[1.2.3.4]"))
+
+    def test_alias(self):
+        lookup = lambda key: self.resolver.lookup("alias", key)
+        self.assertEqual(lookup("bob@alt.com"), "bob@example.com")
+        self.assertEqual(lookup("fwd@example.com"), "x@ext.org")
+        self.assertEqual(lookup("TEAM@example.com"), "bob@example.com")
+        self.assertEqual(lookup("Mixed@example.com"), "mixed@example.com")
+        self.assertEqual(lookup("sales-eu@example.com"), "sales@example.com")
+        self.assertEqual(lookup("other@example.com"), "catchall@example.com")
+        self.assertEqual(lookup("example.com"), "example.com")
+        self.assertIsNone(lookup("other@example.org"))
+
+    def test_transport(self):
+        self.assertEqual(self.resolver.lookup("transport", "a@relay.org"), "smtp:[1.2.3.4]:26")
+        self.assertEqual(self.resolver.lookup("transport", "a@mx.org"), "smtp:mx.org")
+        self.assertIsNone(self.resolver.lookup("transport", "a@example.com"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -13,11 +13,19 @@ system.set_env(log_filters=[
 
 def start_podop():
     system.drop_privs_to('mail')
-    url = "http://" + os.environ["ADMIN_ADDRESS"] + ":8080/internal/dovecot/§"
+    url = "http://" + os.environ["ADMIN_ADDRESS"] + ":8080/internal/dovecot/"
+    # Lookups are sent to admin in batches
+    batch = dict(batch=url + "batch")
+    # Quota updates are merged and written in bulk a few seconds later
+    quota = dict(batch, write_behind=url + "quota",
+        write_delay=os.environ.get("QUOTA_WRITE_DELAY", "5"))
+    # Passdb entries carry the userdb fields and are cached per user, until
+    # the users change in admin
+    auth = dict(batch, ttl=300, negative_ttl=0, version=url + "version#user")
     run_server(0, "dovecot", "/tmp/podop.socket", [
-		("quota", "url", url ),
-		("auth", "url", url),
-		("sieve", "url", url),
+		("quota", "url", url + "§", quota),
+		("auth", "url", url + "§", auth),
+		("sieve", "url", url + "§", batch),
     ])
 
 # Actual startup script
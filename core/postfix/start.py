@@ -22,17 +22,39 @@ def start_podop():
     system.drop_privs_to('postfix')
     os.makedirs('/dev/shm/postfix',mode=0o700, exist_ok=True)
     url = "http://" + os.environ["ADMIN_ADDRESS"] + ":8080/internal/postfix/"
+    # Lookups are sent to admin in batches, except for slow DANE lookups
+    batch = url + "batch"
+    # Lookups are cached for a few seconds (ttl for hits, negative_ttl for
+    # misses); senderrate must never be cached nor coalesced as every
+    # lookup is a hit
+    cache = dict(ttl=30, negative_ttl=10, batch=batch)
+    # Maps listed in POSTFIX_SQL_MAPS are read straight from the database
+    db_url = os.environ.get("SQLALCHEMY_DATABASE_URI", "")
+    sql_maps = set() if not db_url or db_url.startswith("sqlite") else {
+        name.strip() for name in os.environ.get("POSTFIX_SQL_MAPS", "").split(",")
+    }
+    # Other routing maps are answered from an in-memory snapshot of the
+    # routing records, kept up to date by polling admin
+    snapshot = url + "snapshot"
+    def table(name, path, options=None):
+        if name in sql_maps:
+            options = {key: value for key, value in (options or {}).items() if key != "batch"}
+            return (name, "sql", f"{db_url}#{name}", options)
+        if name in ("transport", "alias", "domain", "mailbox"):
+            return (name, "snapshot", f"{snapshot}#{name}", dict(coalesce=False))
+        return (name, "url", url + path, options)
     # TODO: Remove verbosity setting from Podop?
     run_server(0, "postfix", "/tmp/podop.socket", [
-        ("transport", "url", url + "transport/§"),
-        ("alias", "url", url + "alias/§"),
-        ("dane", "url", url + "dane/§"),
-        ("domain", "url", url + "domain/§"),
-        ("mailbox", "url", url + "mailbox/§"),
-        ("recipientmap", "url", url + "recipient/map/§"),
-        ("sendermap", "url", url + "sender/map/§"),
-        ("senderlogin", "url", url + "sender/login/§"),
-        ("senderrate", "url", url + "sender/rate/§")
+        table("transport", "transport/§", cache),
+        table("alias", "alias/§", cache),
+        table("dane", "dane/§"),
+        table("domain", "domain/§", cache),
+        table("mailbox", "mailbox/§", cache),
+        table("recipientmap", "recipient/map/§", cache),
+        table("sendermap", "sender/map/§", dict(batch=batch)),
+        table("senderlogin", "sender/login/§", cache),
+        table("senderspoofing", "sender/spoofing/§", cache),
+        table("senderrate", "sender/rate/§", dict(coalesce=False, batch=batch))
     ])
 
 def start_mta_sts_daemon():
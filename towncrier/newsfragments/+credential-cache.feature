@@ -0,0 +1 @@
+Verified passwords are remembered as a keyed digest in redis so that later logins skip the slow password hash. The new `CREDENTIAL_CACHE_TTL` setting (default: 86400 seconds, 0 to disable) sets how long.
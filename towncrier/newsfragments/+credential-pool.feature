@@ -0,0 +1 @@
+Password hashes are verified on a bounded pool of threads. The new `CREDENTIAL_THREADS` and `CREDENTIAL_QUEUE` settings (defaults derived from `CPU_COUNT`) size it; logins beyond the queue are refused with a rate-limit error instead of blocking the admin container.
@@ -0,0 +1 @@
+DANE lookups of outbound domains are cached by the admin container. The new `DANE_CACHE_NEGATIVE_TTL` (default: 600 seconds) and `DANE_CACHE_SIZE` (default: 10000 domains) settings bound the cache.
@@ -0,0 +1 @@
+Quota updates from dovecot are merged and written in bulk. The new `QUOTA_WRITE_DELAY` setting (default: 5 seconds) is the maximum time an update is kept in memory before being stored.
@@ -0,0 +1 @@
+The new `AUTH_RATELIMIT_IP_STRATEGY`, `AUTH_RATELIMIT_USER_STRATEGY` and `MESSAGE_RATELIMIT_STRATEGY` settings (default: moving-window) select how rate limits are counted; `fixed-window` stores a single counter per key.
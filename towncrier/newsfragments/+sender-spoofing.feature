@@ -0,0 +1 @@
+Users allowed to spoof and WILDCARD_SENDERS are now checked by a new postfix `senderspoofing` map (`check_spoofing` in main.cf, added to the submission restrictions in master.cf). The `/internal/postfix/sender/login` endpoint now only returns the owners of the sender address. Custom postfix overrides relying on the previous answers should use the new map.
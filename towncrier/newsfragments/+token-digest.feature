@@ -0,0 +1 @@
+App tokens are looked up by a keyed digest instead of checking every token hash of the user. The upgrade runs a database migration adding the `token.digest` column; the digest of existing tokens is set on their next successful use.